@@ -2,130 +2,2649 @@
 import eventlet
 eventlet.monkey_patch()
 
+import eventlet.semaphore
+from eventlet import tpool
 import os
 import time
 import threading
 from pathlib import Path
 from datetime import datetime, timedelta
-from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, make_response, flash
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, make_response, flash, Response, Request, g, session
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms as socket_rooms
 import random
+import json
+import re
+import queue
+import sqlite3
+import heapq
+from collections import deque, Counter
+from itertools import islice
+from contextlib import contextmanager
+import hashlib
+import secrets
+import atexit
+import gc
+import sys
+import functools
 import zipfile
-import io
+import zlib
+import mmap
+import bisect
+import shutil
+import gzip
+import mimetypes
+from collections import OrderedDict
+from werkzeug.security import safe_join
+from urllib.parse import quote
+
+try:
+    import fcntl  # POSIX only: locks blob files across workers sharing a SQLite store
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli  # optional: adds a 'br' variant to cached pages and static files
+except ImportError:
+    brotli = None
 
 # ────────────────────────────────────────────────
 #  APP & SOCKET.IO CONFIGURATION
 # ────────────────────────────────────────────────
 
-app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "your-secret-key-here-change-in-production")
-app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max upload size
+app = Flask(__name__)
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "your-secret-key-here-change-in-production")
+app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max upload size
+
+# 🟢 CONFIG: Using 'eventlet' for async mode (Required for Render)
+# SOCKETIO_MESSAGE_QUEUE (e.g. redis://host:6379/0) lets emits reach clients on every worker
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet',
+                    message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+# Blobs and partial uploads; put it on a persistent disk together with ROOM_JOURNAL_PATH
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "uploads")
+ROOM_DURATION_MINS = 15
+
+# Room state backend: unset = in-process memory (single worker),
+# "sqlite:///path/to/rooms.db" = shared between workers/processes on one host
+ROOM_STORE_URL = os.environ.get("ROOM_STORE_URL", "")
+
+# In-memory store only: room changes are appended to this journal (plus a periodic snapshot)
+# and replayed on startup, so restarts keep rooms. Empty = no journal.
+ROOM_JOURNAL_PATH = os.environ.get("ROOM_JOURNAL_PATH", "rooms.journal")
+JOURNAL_FLUSH_SECS = 0.2
+JOURNAL_SNAPSHOT_RECORDS = 10000
+# Room versions after the n-th journal replay start at n * this, above any version handed out
+# before (history isn't journaled, so the last version itself is not known after a restart)
+ROOM_VERSION_EPOCH_SPAN = 2 ** 32
+# Startup reclamation leaves files this young alone (another worker may be writing them),
+# and only ever touches blob names and .part_ files
+RECLAIM_GRACE_SECS = 300
+BLOB_NAME_RE = re.compile(r"[0-9a-f]{64}")
+
+# Room codes: digits per code (10**digits codes in total). Lengthen once /metrics shows
+# room_code_occupancy getting high; the code inputs in the templates expect 6 digits.
+ROOM_CODE_DIGITS = 6
+ROOM_CODE_FEISTEL_ROUNDS = 8
+# Released codes remembered for reuse; older ones are dropped and come back with the next counter pass
+ROOM_CODE_FREE_MAX = 10000
+
+# History: entries kept per room (oldest dropped first) and entries rendered on the room page
+HISTORY_CAPACITY = int(os.environ.get("HISTORY_CAPACITY", 200))
+HISTORY_PAGE_SIZE = 50
+
+# Longest the expiry scheduler sleeps without checking the store again
+EXPIRY_MAX_SLEEP_SECS = 60
+
+# Streaming ZIP: read size per chunk and file types that are already compressed
+ZIP_CHUNK_SIZE = 64 * 1024
+ZIP_STORED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic",
+    "mp3", "mp4", "m4a", "mov", "mkv", "avi", "webm",
+    "zip", "rar", "7z", "gz", "tgz", "bz2", "xz",
+    "pdf", "docx", "xlsx", "pptx", "apk",
+}
+
+# Hot-file cache: blobs downloaded again while they are still among the last
+# FILE_CACHE_CANDIDATES requested ones are served from read-only mmaps, up to this many bytes
+# in total (0 = off, the default). Everything else, bigger files and Range requests go out from
+# disk via sendfile.
+FILE_CACHE_BYTES = int(os.environ.get("FILE_CACHE_BYTES", 0))
+FILE_CACHE_MAX_FILE = 32 * 1024 * 1024
+FILE_CACHE_CANDIDATES = 4096
+# Finished "download all" archives kept in memory, keyed by room and file list (0 = off)
+ARCHIVE_CACHE_BYTES = int(os.environ.get("ARCHIVE_CACHE_BYTES", 128 * 1024 * 1024))
+ARCHIVE_CACHE_MAX_ARCHIVE = 32 * 1024 * 1024
+
+# Bandwidth shaping with token buckets, in bytes per second (0 = no limit, the default): per user
+# (user_id cookie, client IP without one) and per room, on upload and download bodies. Idle buckets
+# refill to BANDWIDTH_BURST_SECS worth of bytes, which can then be sent at full speed. Shaped
+# downloads are paced in Python, so they don't go out through sendfile.
+USER_BANDWIDTH_BPS = int(os.environ.get("USER_BANDWIDTH_BPS", 0))
+ROOM_BANDWIDTH_BPS = int(os.environ.get("ROOM_BANDWIDTH_BPS", 0))
+BANDWIDTH_BURST_SECS = 2
+# Bytes taken from the buckets per step; small steps interleave streams sharing a bucket fairly
+SHAPING_CHUNK_SIZE = 64 * 1024
+
+# Admin endpoints (/admin/...) need "Authorization: Bearer <ADMIN_TOKEN>"; unset = disabled
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Requests slower than this (time to response headers) get a stack trace recorded (0 = off)
+SLOW_REQUEST_SECS = float(os.environ.get("SLOW_REQUEST_SECS", 2.0))
+SLOW_TRACE_INTERVAL_SECS = 0.05
+SLOW_TRACE_CAPACITY = 50
+# Sampling profiler window and rate limits
+PROFILE_DEFAULT_SECS = 30
+PROFILE_MAX_SECS = 300
+PROFILE_DEFAULT_HZ = 100
+PROFILE_MAX_HZ = 1000
+
+# Chunked (resumable) uploads: default/min/max chunk size and largest file per session
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_CHUNK_MIN = 256 * 1024
+UPLOAD_CHUNK_MAX = 16 * 1024 * 1024
+UPLOAD_SESSION_MAX_SIZE = int(os.environ.get("UPLOAD_SESSION_MAX_SIZE", app.config["MAX_CONTENT_LENGTH"]))
+
+# new_files / file_downloaded events for a room are coalesced over this window (0 = send immediately)
+EVENT_BATCH_WINDOW_MS = int(os.environ.get("EVENT_BATCH_WINDOW_MS", 250))
+
+# P2P mode: browsers in a room send files to each other over WebRTC, the server only relays
+# the signaling messages. ICE servers are passed to the browser as-is (JSON list).
+P2P_ENABLED = os.environ.get("P2P_ENABLED", "1") == "1"
+P2P_ICE_SERVERS = json.loads(os.environ.get("P2P_ICE_SERVERS", '[{"urls": "stun:stun.l.google.com:19302"}]'))
+
+# Live pipe relay: uploads are teed to receivers already streaming them. Per pipe: memory
+# buffer size, read size, how long the sender waits for a slow receiver before that
+# receiver continues from disk, and how long a finished pipe redirects to the stored file.
+# Pipes and room presence only exist in the worker process that holds them, so with a message
+# queue (several workers) live uploads are off and clients use resumable chunked uploads.
+LIVE_PIPES_ENABLED = not SOCKETIO_MESSAGE_QUEUE
+PIPE_BUFFER_BYTES = int(os.environ.get("PIPE_BUFFER_BYTES", 8 * 1024 * 1024))
+PIPE_CHUNK_SIZE = 256 * 1024
+PIPE_STALL_SECS = 10
+PIPE_LINGER_SECS = 60
+
+# Blocking disk I/O runs on this many OS threads (eventlet.tpool) instead of the hub
+IO_THREADS = int(os.environ.get("IO_THREADS", 8))
+# Uploads are read and written in larger pieces so each thread hop moves more bytes
+IO_CHUNK_SIZE = 1024 * 1024
+
+# Storage budgets: bytes per room and across all rooms (files + open upload sessions, 0 = no limit),
+# and disk usage fractions of the UPLOAD_FOLDER filesystem. Above the high watermark uploads are
+# refused and the oldest rooms whose files free space are evicted until usage is back under the
+# low watermark (if deleting them can get it there at all).
+ROOM_QUOTA_BYTES = int(os.environ.get("ROOM_QUOTA_BYTES", 500 * 1024 * 1024))
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", 5 * 1024 * 1024 * 1024))
+DISK_HIGH_WATERMARK = float(os.environ.get("DISK_HIGH_WATERMARK", 0.90))
+DISK_LOW_WATERMARK = float(os.environ.get("DISK_LOW_WATERMARK", 0.80))
+# Rooms younger than this are never evicted for disk space
+DISK_EVICT_MIN_AGE_SECS = int(os.environ.get("DISK_EVICT_MIN_AGE_SECS", 5 * 60))
+
+# Pre-compressed response cache: browser cache lifetimes for pages / static files,
+# static files served from memory up to this size, and how often sources are re-stat'ed
+PAGE_MAX_AGE = 300
+STATIC_MAX_AGE = 60 * 60
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+STATIC_CACHE_MAX_FILE = 2 * 1024 * 1024
+RESPONSE_CACHE_ENTRIES = 64
+SOURCE_CHECK_SECS = 2
+
+# Ensure upload directory exists
+Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
+
+# ────────────────────────────────────────────────
+#  🆕 METRICS (PROMETHEUS TEXT FORMAT)
+# ────────────────────────────────────────────────
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOCK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+# /metrics walks UPLOAD_FOLDER at most this often
+DISK_USAGE_CACHE_SECS = 30
+
+class Histogram:
+    """Fixed-bucket histogram. observe() is one bisect and a few additions."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def expose(self, name, labels=""):
+        """Prometheus sample lines with cumulative buckets."""
+        prefix = labels + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class Metrics:
+    """Process-wide counters scraped by GET /metrics (one set per worker)."""
+
+    def __init__(self):
+        self.request_latency = {}   # (route, method) -> Histogram
+        self.responses = {}         # (route, method, status) -> count
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.socket_connections = 0
+        self.p2p_signals = 0
+        self.pipe_bytes = {"memory": 0, "disk": 0}
+        self.rooms_expired = 0
+        self.cleanup_sweeps = Histogram()
+        self.zip_builds = Histogram()
+        self.disk_usage = (float("-inf"), (0, 0))  # (measured at, (bytes, files))
+
+    def observe_request(self, route, method, status, seconds):
+        key = (route, method)
+        hist = self.request_latency.get(key)
+        if hist is None:
+            hist = self.request_latency[key] = Histogram()
+        hist.observe(seconds)
+        key = (route, method, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+
+metrics = Metrics()
+
+# ────────────────────────────────────────────────
+#  ROOM STORE (IN-MEMORY OR SHARED)
+# ────────────────────────────────────────────────
+
+def merge_range(ranges, start, end):
+    """Insert [start, end) into a sorted list of disjoint ranges, merging neighbours."""
+    merged = []
+    for r_start, r_end in ranges:
+        if r_end < start or r_start > end:
+            merged.append([r_start, r_end])
+        else:
+            start, end = min(start, r_start), max(end, r_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+class HistoryEntry:
+    """One line of room activity.
+
+    `seq` is assigned by the store and is the pagination cursor; `version` is
+    the room version the entry was added at (see RoomStore.get_changes).
+    """
+
+    __slots__ = ("seq", "ts", "user", "action", "version")
+
+    def __init__(self, user, action, ts=None, seq=None, version=0):
+        self.seq = seq
+        self.ts = ts if ts is not None else time.time()
+        self.user = user
+        self.action = action
+        self.version = version
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.ts).strftime("%H:%M:%S")
+
+    def as_dict(self):
+        return {"seq": self.seq, "user": self.user, "action": self.action, "time": self.time, "ts": self.ts,
+                "version": self.version}
+
+class RoomStore:
+    """Room metadata (files, history, timestamps), upload sessions and blob reference counts.
+
+    Routes only talk to this interface, so the state can live in process
+    memory or in a store shared by several workers.
+    """
+
+    # Rooms
+    def create_room(self, code, timestamp):
+        """Create an empty room. Returns False if the code is already taken."""
+        raise NotImplementedError
+
+    def room_exists(self, code):
+        raise NotImplementedError
+
+    def get_room(self, code, history_limit=HISTORY_PAGE_SIZE):
+        """Snapshot of a room, or None.
+
+        {"timestamp", "version", "files", "history": newest `history_limit` entries
+        oldest-first, "history_more": True if older entries exist}
+        """
+        raise NotImplementedError
+
+    def get_changes(self, code, since, history_limit=HISTORY_PAGE_SIZE):
+        """Files and history entries added after room version `since`, or None.
+
+        Every added file and history entry bumps the room's version by one and
+        is stamped with it; versions never go backwards, also across restarts.
+        Returns {"version", "files", "history" (oldest-first, at most
+        `history_limit`), "history_more", "full"}. When `since` is None or a
+        version this room never reached, "full" is True and the result holds
+        all files, like get_room().
+        """
+        raise NotImplementedError
+
+    def get_history(self, code, before=None, limit=HISTORY_PAGE_SIZE):
+        """Page of history entries newest-first with seq < `before`.
+
+        Returns (entries, next_before) where next_before is the cursor for the
+        next older page or None, or None if the room does not exist.
+        """
+        raise NotImplementedError
+
+    def get_files(self, code):
+        """List of file entries of a room, or None if the room does not exist."""
+        raise NotImplementedError
+
+    def get_file(self, code, index):
+        raise NotImplementedError
+
+    def add_files(self, code, records, history_entry=None):
+        """Append file entries (assigning their index and version) and optionally a history entry.
+
+        Returns the entries that were added, [] if the room is gone.
+        """
+        raise NotImplementedError
+
+    def add_history(self, code, entry):
+        """Append a HistoryEntry, dropping the oldest beyond HISTORY_CAPACITY.
+
+        Returns False if the room does not exist.
+        """
+        raise NotImplementedError
+
+    def delete_room(self, code):
+        """Remove a room and its upload sessions.
+
+        Returns {"files": [...], "parts": [...]} for the caller to clean up, or None.
+        """
+        raise NotImplementedError
+
+    def expired_rooms(self, cutoff):
+        """Codes of rooms created at or before `cutoff`, oldest first, for the caller to delete.
+
+        Cost is proportional to the number of rooms returned, not to the number of live rooms.
+        A store may drop the returned rooms from its expiry schedule.
+        """
+        raise NotImplementedError
+
+    def oldest_rooms(self, cutoff):
+        """Codes of rooms created at or before `cutoff`, oldest first, leaving the schedule alone."""
+        raise NotImplementedError
+
+    def next_expiry(self):
+        """Creation time of the oldest room, or None when there are no rooms."""
+        raise NotImplementedError
+
+    def room_count(self):
+        raise NotImplementedError
+
+    def file_count(self):
+        """Files across all rooms."""
+        raise NotImplementedError
+
+    def stored_bytes(self, code=None):
+        """Bytes of files plus declared sizes of open upload sessions, for one room or all.
+
+        Counted per room, so content shared between rooms is counted more than once.
+        Kept as running totals, so it is cheap enough to check on every upload.
+        """
+        raise NotImplementedError
+
+    def referenced_files(self):
+        """Names in UPLOAD_FOLDER that some room or upload session still points at."""
+        raise NotImplementedError
+
+    def freeable_bytes(self, code):
+        """Disk space deleting a room would give back: its blobs no other room references
+        plus the bytes received so far by its upload sessions. 0 if the room does not exist.
+        """
+        raise NotImplementedError
+
+    def lock_stats(self):
+        """Lock contention counters, {} for stores that don't use in-process locks."""
+        return {}
+
+    # Chunked upload sessions
+    def create_upload(self, upload_id, session):
+        raise NotImplementedError
+
+    def get_upload(self, upload_id):
+        raise NotImplementedError
+
+    def add_upload_range(self, upload_id, start, end):
+        """Mark [start, end) as received. Returns the updated session or None."""
+        raise NotImplementedError
+
+    def pop_upload(self, upload_id):
+        raise NotImplementedError
+
+    # Blob reference counts
+    def incref_blob(self, digest, install):
+        """Take a reference; `install()` runs when the blob is new, before anyone can remove it."""
+        raise NotImplementedError
+
+    def decref_blob(self, digest, remove):
+        """Drop a reference; `remove()` runs when the count reaches zero, before anyone can reinstall it."""
+        raise NotImplementedError
+
+class LockStats:
+    """Acquisition and contention counters shared by a group of locks."""
+
+    __slots__ = ("acquired", "contended", "wait_seconds", "wait", "hold")
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        # Wait is only recorded for contended acquisitions, hold for every one
+        self.wait = Histogram(LOCK_BUCKETS)
+        self.hold = Histogram(LOCK_BUCKETS)
+
+    def as_dict(self):
+        return {"acquired": self.acquired, "contended": self.contended,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "hold_seconds": round(self.hold.sum, 6)}
+
+class CountingLock:
+    """threading.Lock that records in its LockStats how long callers waited and held it."""
+
+    __slots__ = ("_lock", "_stats", "_held_since")
+
+    def __init__(self, stats):
+        self._lock = threading.Lock()
+        self._stats = stats
+        self._held_since = 0.0
+
+    def __enter__(self):
+        stats = self._stats
+        # Only time the wait on the slow path, so uncontended acquisitions stay cheap
+        if not self._lock.acquire(False):
+            started = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - started
+            stats.contended += 1
+            stats.wait_seconds += waited
+            stats.wait.observe(waited)
+        stats.acquired += 1
+        self._held_since = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # Safe to use the instance field: only the holder gets here
+        self._stats.hold.observe(time.perf_counter() - self._held_since)
+        self._lock.release()
+
+class InMemoryRoomStore(RoomStore):
+    """Plain dicts in process memory. Only valid with a single worker.
+
+    Each room has its own lock for its files and history; the registry lock
+    is only held briefly to look up, create or remove rooms.
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._uploads = {}
+        self._blob_refs = {}
+        # Running byte counts for quota checks: files of all rooms (per room in room["bytes"])
+        # and declared sizes of open upload sessions, per room and in total
+        self._file_bytes = 0
+        self._upload_bytes = {}
+        self._upload_total = 0
+        # Min-heap of (timestamp, code); entries of destroyed rooms are skipped lazily
+        self._expiry_heap = []
+        self.registry_lock_stats = LockStats()
+        self.room_lock_stats = LockStats()
+        # 🟢 LOCK: Short global section for creating, finding and removing rooms
+        self.lock = CountingLock(self.registry_lock_stats)
+        self._upload_lock = threading.Lock()
+        self._blob_lock = threading.Lock()
+
+    def _room(self, code):
+        with self.lock:
+            return self._rooms.get(code)
+
+    def lock_stats(self):
+        return {"registry": self.registry_lock_stats.as_dict(), "room": self.room_lock_stats.as_dict()}
+
+    def _new_room(self, timestamp):
+        return {
+            "timestamp": timestamp,
+            "files": [],
+            "history": deque(maxlen=HISTORY_CAPACITY),
+            "history_seq": 0,
+            "version": 0,
+            "bytes": 0,
+            "lock": CountingLock(self.room_lock_stats),
+            "deleted": False
+        }
+
+    def create_room(self, code, timestamp):
+        with self.lock:
+            if code in self._rooms:
+                return False
+            self._rooms[code] = self._new_room(timestamp)
+            heapq.heappush(self._expiry_heap, (timestamp, code))
+            return True
+
+    def room_exists(self, code):
+        with self.lock:
+            return code in self._rooms
+
+    def get_room(self, code, history_limit=HISTORY_PAGE_SIZE):
+        room = self._room(code)
+        if room is None:
+            return None
+        with room["lock"]:
+            if room["deleted"]:
+                return None
+            # Copy so callers can iterate outside the lock
+            history = room["history"]
+            skip = max(0, len(history) - history_limit)
+            return {
+                "timestamp": room["timestamp"],
+                "version": room["version"],
+                "files": list(room["files"]),
+                "history": list(islice(history, skip, None)),
+                "history_more": skip > 0
+            }
+
+    def get_changes(self, code, since, history_limit=HISTORY_PAGE_SIZE):
+        room = self._room(code)
+        if room is None:
+            return None
+        with room["lock"]:
+            if room["deleted"]:
+                return None
+            version = room["version"]
+            full = since is None or not 0 <= since <= version
+            if full:
+                since = -1  # Also entries from before versions existed (version 0)
+            # Both lists are in version order, so only the new tail is visited
+            files = room["files"]
+            start = len(files)
+            while start > 0 and files[start - 1].get("version", 0) > since:
+                start -= 1
+            history = []
+            for entry in reversed(room["history"]):
+                if entry.version <= since or len(history) > history_limit:
+                    break
+                history.append(entry)
+            return {
+                "version": version,
+                "files": files[start:],
+                "history": history[:history_limit][::-1],
+                "history_more": len(history) > history_limit,
+                "full": full
+            }
+
+    def get_history(self, code, before=None, limit=HISTORY_PAGE_SIZE):
+        room = self._room(code)
+        if room is None:
+            return None
+        with room["lock"]:
+            if room["deleted"]:
+                return None
+            history = room["history"]
+            if not history:
+                return [], None
+            # Sequence numbers in the ring are consecutive, so the cursor maps straight to a position
+            end = len(history) if before is None else min(max(before - history[0].seq, 0), len(history))
+            start = max(0, end - limit)
+            entries = [history[i] for i in range(end - 1, start - 1, -1)]
+            return entries, (history[start].seq if start > 0 else None)
+
+    def get_files(self, code):
+        room = self._room(code)
+        if room is None:
+            return None
+        with room["lock"]:
+            return list(room["files"]) if not room["deleted"] else None
+
+    def get_file(self, code, index):
+        room = self._room(code)
+        if room is None:
+            return None
+        with room["lock"]:
+            if not room["deleted"] and 0 <= index < len(room["files"]):
+                return room["files"][index]
+        return None
+
+    def add_files(self, code, records, history_entry=None):
+        room = self._room(code)
+        if room is None:
+            return []
+        with room["lock"]:
+            if room["deleted"]:
+                return []
+            current_count = len(room["files"])
+            for i, f_data in enumerate(records):
+                room["version"] += 1
+                f_data["index"] = current_count + i
+                f_data["version"] = room["version"]
+                room["files"].append(f_data)
+                room["bytes"] += f_data.get("size_bytes", 0)
+                self._file_bytes += f_data.get("size_bytes", 0)
+            if history_entry:
+                self._append_history(room, history_entry)
+            return list(records)
+
+    def add_history(self, code, entry):
+        room = self._room(code)
+        if room is None:
+            return False
+        with room["lock"]:
+            if room["deleted"]:
+                return False
+            self._append_history(room, entry)
+            return True
+
+    @staticmethod
+    def _append_history(room, entry):
+        room["history_seq"] += 1
+        room["version"] += 1
+        entry.seq = room["history_seq"]
+        entry.version = room["version"]
+        room["history"].append(entry)  # deque(maxlen) drops the oldest
+
+    def delete_room(self, code):
+        with self.lock:
+            room = self._rooms.pop(code, None)
+        if room is None:
+            return None
+        # Writers that looked the room up before it was removed see the flag and back off
+        with room["lock"]:
+            room["deleted"] = True
+            files = list(room["files"])
+            self._file_bytes -= room["bytes"]
+        with self._upload_lock:
+            upload_ids = [uid for uid, sess in self._uploads.items() if sess["code"] == code]
+            parts = [self._forget_upload(uid)["part_name"] for uid in upload_ids]
+        return {"files": files, "parts": parts}
+
+    def _is_live_entry(self, timestamp, code):
+        room = self._rooms.get(code)
+        return room is not None and room["timestamp"] == timestamp
+
+    def expired_rooms(self, cutoff):
+        expired = []
+        with self.lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= cutoff:
+                timestamp, code = heapq.heappop(heap)
+                if self._is_live_entry(timestamp, code):
+                    expired.append(code)
+        return expired
+
+    def oldest_rooms(self, cutoff):
+        with self.lock:
+            live = [(room["timestamp"], code) for code, room in self._rooms.items() if room["timestamp"] <= cutoff]
+        return [code for _, code in sorted(live)]
+
+    def next_expiry(self):
+        with self.lock:
+            heap = self._expiry_heap
+            while heap and not self._is_live_entry(*heap[0]):
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def room_count(self):
+        return len(self._rooms)
+
+    def file_count(self):
+        with self.lock:
+            live = list(self._rooms.values())
+        return sum(len(room["files"]) for room in live)
+
+    def stored_bytes(self, code=None):
+        if code is None:
+            return self._file_bytes + self._upload_total
+        room = self._rooms.get(code)
+        return (room["bytes"] if room else 0) + self._upload_bytes.get(code, 0)
+
+    def referenced_files(self):
+        with self.lock:
+            live = list(self._rooms.values())
+        names = {f["stored_name"] for room in live for f in room["files"]}
+        with self._upload_lock:
+            names.update(sess["part_name"] for sess in self._uploads.values())
+        return names
+
+    def freeable_bytes(self, code):
+        room = self._room(code)
+        if room is None:
+            return 0
+        with room["lock"]:
+            uses = Counter(f["stored_name"] for f in room["files"])
+            sizes = {f["stored_name"]: f["size_bytes"] for f in room["files"]}
+        with self._blob_lock:
+            total = sum(sizes[name] for name, n in uses.items() if self._blob_refs.get(name, 0) <= n)
+        with self._upload_lock:
+            total += sum(end - start for sess in self._uploads.values() if sess["code"] == code
+                         for start, end in sess["received"])
+        return total
+
+    def create_upload(self, upload_id, session):
+        with self._upload_lock:
+            self._uploads[upload_id] = dict(session)
+            self._upload_bytes[session["code"]] = self._upload_bytes.get(session["code"], 0) + session["size"]
+            self._upload_total += session["size"]
+
+    def _forget_upload(self, upload_id):
+        """Remove a session and its bytes from the counters (under _upload_lock)."""
+        session = self._uploads.pop(upload_id, None)
+        if session is not None:
+            remaining = self._upload_bytes.get(session["code"], 0) - session["size"]
+            if remaining > 0:
+                self._upload_bytes[session["code"]] = remaining
+            else:
+                self._upload_bytes.pop(session["code"], None)
+            self._upload_total -= session["size"]
+        return session
+
+    def get_upload(self, upload_id):
+        with self._upload_lock:
+            session = self._uploads.get(upload_id)
+            return dict(session) if session else None
+
+    def add_upload_range(self, upload_id, start, end):
+        with self._upload_lock:
+            session = self._uploads.get(upload_id)
+            if session is None:
+                return None
+            session["received"] = merge_range(session["received"], start, end)
+            return dict(session)
+
+    def pop_upload(self, upload_id):
+        with self._upload_lock:
+            return self._forget_upload(upload_id)
+
+    def incref_blob(self, digest, install):
+        with self._blob_lock:
+            count = self._blob_refs.get(digest, 0)
+            if not count:
+                install()
+            self._blob_refs[digest] = count + 1
+            return count + 1
+
+    def decref_blob(self, digest, remove):
+        with self._blob_lock:
+            count = self._blob_refs.get(digest, 0) - 1
+            if count > 0:
+                self._blob_refs[digest] = count
+                return count
+            self._blob_refs.pop(digest, None)
+            # Remove under the lock so a concurrent upload of the same content can't lose its file
+            remove()
+            return 0
+
+class SQLiteRoomStore(RoomStore):
+    """Room state in a SQLite database (WAL mode) shared by all workers on the host.
+
+    Queries run on the I/O pool: a worker waiting for another worker's write
+    transaction waits on a pool thread inside SQLite's busy handler, not on
+    the hub. Transactions never span a yield back to the hub.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rooms (code TEXT PRIMARY KEY, created REAL NOT NULL,
+                                          version INTEGER NOT NULL DEFAULT 0, bytes INTEGER NOT NULL DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS rooms_created ON rooms (created);
+        CREATE TABLE IF NOT EXISTS files (code TEXT NOT NULL, idx INTEGER NOT NULL, data TEXT NOT NULL,
+                                          PRIMARY KEY (code, idx));
+        CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT NOT NULL,
+                                            data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS history_code ON history (code, id);
+        CREATE TABLE IF NOT EXISTS uploads (upload_id TEXT PRIMARY KEY, code TEXT NOT NULL, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS uploads_code ON uploads (code);
+        CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, refs INTEGER NOT NULL);
+        -- Single row: stored_bytes() of all rooms
+        CREATE TABLE IF NOT EXISTS storage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+    """
+
+    # Blob installs/removals are serialized per stripe of digests (byte-range locks on one file)
+    BLOB_LOCK_STRIPES = 256
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self._pool = queue.LifoQueue()
+        # Green lock: writers of this process queue here instead of tying up several pool
+        # threads in SQLite's busy handler
+        self._write_lock = threading.Lock()
+        self._blob_locks = [threading.Lock() for _ in range(self.BLOB_LOCK_STRIPES)]
+        self._blob_lock_file = open(path + ".blobs.lock", "a+b") if fcntl else None
+        for _ in range(pool_size):
+            conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._pool.put(conn)
+        # Runs at import, before anything else needs the hub
+        conn = self._pool.get()
+        try:
+            conn.executescript(self.SCHEMA)
+            self._transaction(conn, self._migrate)
+        finally:
+            self._pool.put(conn)
+
+    @staticmethod
+    def _migrate(conn):
+        """Bring databases created by older versions up to date (inside a transaction)."""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(rooms)")}
+        if "version" not in columns:
+            conn.execute("ALTER TABLE rooms ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if "bytes" not in columns:
+            conn.execute("ALTER TABLE rooms ADD COLUMN bytes INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""UPDATE rooms SET bytes =
+                                COALESCE((SELECT SUM(json_extract(data, '$.size_bytes')) FROM files
+                                          WHERE files.code = rooms.code), 0)
+                              + COALESCE((SELECT SUM(json_extract(data, '$.size')) FROM uploads
+                                          WHERE uploads.code = rooms.code), 0)""")
+        conn.execute("""INSERT OR IGNORE INTO storage (id, bytes) VALUES (0,
+                            COALESCE((SELECT SUM(json_extract(data, '$.size_bytes')) FROM files), 0)
+                          + COALESCE((SELECT SUM(json_extract(data, '$.size')) FROM uploads), 0))""")
+
+    @staticmethod
+    def _add_stored_bytes(conn, code, nbytes):
+        """Move the running byte counts of a room and of all rooms (inside _write())."""
+        conn.execute("UPDATE rooms SET bytes = bytes + ? WHERE code = ?", (nbytes, code))
+        conn.execute("UPDATE storage SET bytes = bytes + ? WHERE id = 0", (nbytes,))
+
+    def _read(self, query, *args):
+        """Run query(conn, *args) on the I/O pool with a pooled connection."""
+        conn = self._pool.get()
+        try:
+            return io_pool.run(query, conn, *args)
+        finally:
+            self._pool.put(conn)
+
+    @staticmethod
+    def _transaction(conn, query, *args):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = query(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _write(self, query, *args):
+        """Run query(conn, *args) as a read-modify-write transaction, serialized across processes."""
+        with self._write_lock:
+            return self._read(self._transaction, query, *args)
+
+    @contextmanager
+    def _blob_lock(self, digest):
+        """Exclusive over one digest's count and file in every process, outside any transaction."""
+        stripe = zlib.crc32(digest.encode()) % self.BLOB_LOCK_STRIPES
+        with self._blob_locks[stripe]:
+            if self._blob_lock_file is None:
+                yield  # No fcntl (Windows): only serialized within this process
+                return
+            fd = self._blob_lock_file.fileno()
+            io_pool.run(fcntl.lockf, fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, stripe)
+
+    def create_room(self, code, timestamp):
+        def insert(conn):
+            cur = conn.execute("INSERT OR IGNORE INTO rooms (code, created) VALUES (?, ?)",
+                               (code, timestamp.timestamp()))
+            return cur.rowcount == 1
+        return self._write(insert)
+
+    @staticmethod
+    def _room_exists(conn, code):
+        return conn.execute("SELECT 1 FROM rooms WHERE code = ?", (code,)).fetchone() is not None
+
+    def room_exists(self, code):
+        return self._read(self._room_exists, code)
+
+    @staticmethod
+    def _history_entry(row):
+        # [ts, user, action, version]; entries written before versions existed have no version
+        data = json.loads(row[1])
+        return HistoryEntry(data[1], data[2], ts=data[0], seq=row[0], version=data[3] if len(data) > 3 else 0)
+
+    @staticmethod
+    def _bump_version(conn, code, n):
+        """Reserve `n` consecutive versions of a room (inside _write()); returns the first."""
+        conn.execute("UPDATE rooms SET version = version + ? WHERE code = ?", (n, code))
+        return conn.execute("SELECT version FROM rooms WHERE code = ?", (code,)).fetchone()[0] - n + 1
+
+    def get_room(self, code, history_limit=HISTORY_PAGE_SIZE):
+        def query(conn):
+            row = conn.execute("SELECT created, version FROM rooms WHERE code = ?", (code,)).fetchone()
+            if row is None:
+                return None
+            files = conn.execute("SELECT data FROM files WHERE code = ? ORDER BY idx", (code,)).fetchall()
+            history = conn.execute("SELECT id, data FROM history WHERE code = ? ORDER BY id DESC LIMIT ?",
+                                   (code, history_limit + 1)).fetchall()
+            return {
+                "timestamp": datetime.fromtimestamp(row[0]),
+                "version": row[1],
+                "files": [json.loads(r[0]) for r in files],
+                "history": [self._history_entry(r) for r in reversed(history[:history_limit])],
+                "history_more": len(history) > history_limit
+            }
+        return self._read(query)
+
+    def get_changes(self, code, since, history_limit=HISTORY_PAGE_SIZE):
+        def query(conn):
+            # One read transaction, so the version matches the rows returned with it
+            conn.execute("BEGIN")
+            try:
+                row = conn.execute("SELECT version FROM rooms WHERE code = ?", (code,)).fetchone()
+                if row is None:
+                    return None
+                version = row[0]
+                full = since is None or not 0 <= since <= version
+                # Full: also rows from before versions existed (version 0)
+                after = -1 if full else since
+                files = conn.execute("""SELECT data FROM files WHERE code = ?
+                                        AND COALESCE(json_extract(data, '$.version'), 0) > ? ORDER BY idx""",
+                                     (code, after)).fetchall()
+                history = conn.execute("""SELECT id, data FROM history WHERE code = ?
+                                          AND COALESCE(json_extract(data, '$[3]'), 0) > ?
+                                          ORDER BY id DESC LIMIT ?""",
+                                       (code, after, history_limit + 1)).fetchall()
+            finally:
+                conn.execute("COMMIT")
+            return {
+                "version": version,
+                "files": [json.loads(r[0]) for r in files],
+                "history": [self._history_entry(r) for r in reversed(history[:history_limit])],
+                "history_more": len(history) > history_limit,
+                "full": full
+            }
+        return self._read(query)
+
+    def get_history(self, code, before=None, limit=HISTORY_PAGE_SIZE):
+        def query(conn):
+            if not self._room_exists(conn, code):
+                return None
+            return conn.execute("SELECT id, data FROM history WHERE code = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                (code, before if before is not None else 2 ** 63 - 1, limit + 1)).fetchall()
+        rows = self._read(query)
+        if rows is None:
+            return None
+        entries = [self._history_entry(r) for r in rows[:limit]]
+        return entries, (entries[-1].seq if len(rows) > limit else None)
+
+    @classmethod
+    def _insert_history(cls, conn, code, entry):
+        entry.version = cls._bump_version(conn, code, 1)
+        cur = conn.execute("INSERT INTO history (code, data) VALUES (?, ?)",
+                           (code, json.dumps([entry.ts, entry.user, entry.action, entry.version])))
+        entry.seq = cur.lastrowid
+        # Keep only the newest HISTORY_CAPACITY entries of the room (ids are shared by all rooms)
+        conn.execute("""DELETE FROM history WHERE code = ? AND id < (
+                            SELECT id FROM history WHERE code = ? ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+                     (code, code, HISTORY_CAPACITY - 1))
+
+    def get_files(self, code):
+        room = self.get_room(code)
+        return room["files"] if room else None
+
+    def get_file(self, code, index):
+        def query(conn):
+            return conn.execute("SELECT data FROM files WHERE code = ? AND idx = ?", (code, index)).fetchone()
+        row = self._read(query)
+        return json.loads(row[0]) if row else None
+
+    def add_files(self, code, records, history_entry=None):
+        def insert(conn):
+            if not self._room_exists(conn, code):
+                return []
+            current_count = conn.execute("SELECT COUNT(*) FROM files WHERE code = ?", (code,)).fetchone()[0]
+            first_version = self._bump_version(conn, code, len(records)) if records else 0
+            for i, f_data in enumerate(records):
+                f_data["index"] = current_count + i
+                f_data["version"] = first_version + i
+                conn.execute("INSERT INTO files (code, idx, data) VALUES (?, ?, ?)",
+                             (code, f_data["index"], json.dumps(f_data)))
+            self._add_stored_bytes(conn, code, sum(f.get("size_bytes", 0) for f in records))
+            if history_entry:
+                self._insert_history(conn, code, history_entry)
+            return list(records)
+        return self._write(insert)
+
+    def add_history(self, code, entry):
+        def insert(conn):
+            if not self._room_exists(conn, code):
+                return False
+            self._insert_history(conn, code, entry)
+            return True
+        return self._write(insert)
+
+    def delete_room(self, code):
+        def delete(conn):
+            row = conn.execute("SELECT bytes FROM rooms WHERE code = ?", (code,)).fetchone()
+            if row is None:
+                return None
+            self._add_stored_bytes(conn, code, -row[0])
+            conn.execute("DELETE FROM rooms WHERE code = ?", (code,))
+            files = conn.execute("SELECT data FROM files WHERE code = ? ORDER BY idx", (code,)).fetchall()
+            parts = conn.execute("SELECT data FROM uploads WHERE code = ?", (code,)).fetchall()
+            for table in ("files", "history", "uploads"):
+                conn.execute(f"DELETE FROM {table} WHERE code = ?", (code,))
+            return files, parts
+        result = self._write(delete)
+        if result is None:
+            return None
+        files, parts = result
+        return {
+            "files": [json.loads(r[0]) for r in files],
+            "parts": [json.loads(r[0])["part_name"] for r in parts]
+        }
+
+    def expired_rooms(self, cutoff):
+        def query(conn):
+            return conn.execute("SELECT code FROM rooms WHERE created <= ? ORDER BY created",
+                                (cutoff.timestamp(),)).fetchall()
+        return [r[0] for r in self._read(query)]
+
+    oldest_rooms = expired_rooms
+
+    def next_expiry(self):
+        def query(conn):
+            return conn.execute("SELECT MIN(created) FROM rooms").fetchone()[0]
+        created = self._read(query)
+        return datetime.fromtimestamp(created) if created is not None else None
+
+    def room_count(self):
+        return self._read(lambda conn: conn.execute("SELECT COUNT(*) FROM rooms").fetchone()[0])
+
+    def file_count(self):
+        return self._read(lambda conn: conn.execute("SELECT COUNT(*) FROM files").fetchone()[0])
+
+    def stored_bytes(self, code=None):
+        def query(conn):
+            if code is None:
+                return conn.execute("SELECT bytes FROM storage WHERE id = 0").fetchone()
+            return conn.execute("SELECT bytes FROM rooms WHERE code = ?", (code,)).fetchone()
+        row = self._read(query)
+        return row[0] if row else 0
+
+    def referenced_files(self):
+        def query(conn):
+            files = conn.execute("SELECT json_extract(data, '$.stored_name') FROM files").fetchall()
+            parts = conn.execute("SELECT json_extract(data, '$.part_name') FROM uploads").fetchall()
+            return {r[0] for r in files} | {r[0] for r in parts}
+        return self._read(query)
+
+    def freeable_bytes(self, code):
+        def query(conn):
+            files = conn.execute("""SELECT SUM(f.size) FROM (
+                                        SELECT json_extract(data, '$.stored_name') AS name,
+                                               MAX(json_extract(data, '$.size_bytes')) AS size, COUNT(*) AS uses
+                                        FROM files WHERE code = ? GROUP BY name) AS f
+                                    LEFT JOIN blobs ON blobs.digest = f.name
+                                    WHERE COALESCE(blobs.refs, 0) <= f.uses""", (code,)).fetchone()[0]
+            parts = conn.execute("SELECT json_extract(data, '$.received') FROM uploads WHERE code = ?",
+                                 (code,)).fetchall()
+            return files, parts
+        files, parts = self._read(query)
+        return (files or 0) + sum(end - start for r in parts for start, end in json.loads(r[0]))
+
+    def create_upload(self, upload_id, session):
+        def insert(conn):
+            conn.execute("INSERT INTO uploads (upload_id, code, data) VALUES (?, ?, ?)",
+                         (upload_id, session["code"], json.dumps(session)))
+            self._add_stored_bytes(conn, session["code"], session["size"])
+        self._write(insert)
+
+    def get_upload(self, upload_id):
+        def query(conn):
+            return conn.execute("SELECT data FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+        row = self._read(query)
+        return json.loads(row[0]) if row else None
+
+    def add_upload_range(self, upload_id, start, end):
+        def update(conn):
+            row = conn.execute("SELECT data FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+            if row is None:
+                return None
+            session = json.loads(row[0])
+            session["received"] = merge_range(session["received"], start, end)
+            conn.execute("UPDATE uploads SET data = ? WHERE upload_id = ?", (json.dumps(session), upload_id))
+            return session
+        return self._write(update)
+
+    def pop_upload(self, upload_id):
+        def delete(conn):
+            row = conn.execute("SELECT code, data FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+            self._add_stored_bytes(conn, row[0], -json.loads(row[1])["size"])
+            return row[1]
+        data = self._write(delete)
+        return json.loads(data) if data else None
+
+    @staticmethod
+    def _add_blob_refs(conn, digest, delta):
+        """Change a blob's count by `delta` (inside _write()); returns the count before."""
+        row = conn.execute("SELECT refs FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        count = row[0] if row else 0
+        if count + delta > 0:
+            conn.execute("INSERT OR REPLACE INTO blobs (digest, refs) VALUES (?, ?)", (digest, count + delta))
+        else:
+            conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        return count
+
+    def incref_blob(self, digest, install):
+        # The count is committed first and the file moved afterwards; the blob lock keeps
+        # a concurrent last decref of the same content from deleting it in between
+        with self._blob_lock(digest):
+            count = self._write(self._add_blob_refs, digest, 1)
+            if not count:
+                try:
+                    install()
+                except BaseException:
+                    self._write(self._add_blob_refs, digest, -1)
+                    raise
+        return count + 1
+
+    def decref_blob(self, digest, remove):
+        with self._blob_lock(digest):
+            count = self._write(self._add_blob_refs, digest, -1) - 1
+            if count <= 0:
+                remove()
+                return 0
+        return count
+
+class RoomJournal:
+    """Append-only file of room changes, one compact JSON array per line.
+
+    append() only queues the line; a background task writes the queue every
+    JOURNAL_FLUSH_SECS, so request handlers never wait for the disk. A crash
+    loses at most that window.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self._pending = []
+        self.records_since_snapshot = 0
+        # Replays so far, carried over into every snapshot
+        self.epoch = 0
+
+    def append(self, record):
+        self._pending.append(json.dumps(record, separators=(",", ":")))
+
+    def _write_lines(self, lines):
+        with open(self.path, "a") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def flush(self, blocking=False):
+        lines, self._pending = self._pending, []
+        if lines:
+            if blocking:
+                self._write_lines(lines)
+            else:
+                io_pool.run(self._write_lines, lines)
+            self.records_since_snapshot += len(lines)
+
+    def write_snapshot(self, state):
+        """Atomically replace the snapshot with `state` and start an empty journal.
+
+        Blocking: call through io_pool, right after flush(). Lines queued in
+        the meantime go to the new journal; replay tolerates records that the
+        snapshot already contains.
+        """
+        tmp = self.snapshot_path + ".tmp"
+        # dumps() + one write uses the C encoder; json.dump() would encode in Python
+        data = json.dumps({"version": 1, "epoch": self.epoch, "rooms": state}, separators=(",", ":"))
+        with open(tmp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        open(self.path, "w").close()
+        self.records_since_snapshot = 0
+
+    def read(self):
+        """(snapshot rooms, journal records).
+
+        A torn last line from a crash is cut off, so new records start on a clean line.
+        """
+        state = []
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = json.loads(f.read())
+            state = snapshot["rooms"]
+            self.epoch = snapshot.get("epoch", 0)
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            # Records are appended as whole lines, so only the tail can be torn
+            good = data.rfind(b"\n") + 1
+            lines = data[:good].splitlines()
+            try:
+                # One decode of the whole journal is much faster than one per line
+                records = json.loads(b"[" + b",".join(lines) + b"]")
+            except ValueError:
+                good = 0
+                for line in lines:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line) + 1
+            if good < len(data):
+                os.truncate(self.path, good)
+        self.records_since_snapshot = len(records)
+        return state, records
+
+class JournaledRoomStore(InMemoryRoomStore):
+    """InMemoryRoomStore whose rooms and files survive restarts.
+
+    Room creation, file additions and deletion go to a RoomJournal; on startup
+    the last snapshot plus the journal are replayed, and the background
+    journal task compacts them into a new snapshot. Upload sessions and
+    history are not kept; unfinished uploads are reclaimed as orphans.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.journal = RoomJournal(path)
+        # Replay allocates hundreds of thousands of long-lived objects; repeated
+        # cyclic GC passes over them would cost more than the replay itself
+        gc.disable()
+        try:
+            self._replay()
+        finally:
+            gc.enable()
+
+    def _replay(self):
+        started = time.perf_counter()
+        state, records = self.journal.read()
+        # Single-threaded at startup: rooms are built directly, the heap is sorted once
+        for code, ts, files in state:
+            self._restore_room(code, ts)
+            self._restore_files(code, files)
+        for record in records:
+            op, code = record[0], record[1]
+            if op == "c":
+                self._restore_room(code, record[2])
+            elif op == "f":
+                self._restore_files(code, record[2])
+            elif op == "d":
+                self._rooms.pop(code, None)
+            elif op == "e":
+                self.journal.epoch = max(self.journal.epoch, record[1])
+        # Written before any new version is handed out, so the next replay starts higher still
+        self.journal.epoch += 1
+        self.journal.append(["e", self.journal.epoch])
+        try:
+            self.journal.flush(blocking=True)
+        except OSError as e:
+            print(f"Error writing room journal: {e}")
+        version_base = self.journal.epoch * ROOM_VERSION_EPOCH_SPAN
+        self._expiry_heap = [(room["timestamp"], code) for code, room in self._rooms.items()]
+        heapq.heapify(self._expiry_heap)
+        for room in self._rooms.values():
+            room["version"] = version_base
+            self._file_bytes += room["bytes"]
+            # Every file record holds one reference to its blob
+            for f in room["files"]:
+                self._blob_refs[f["stored_name"]] = self._blob_refs.get(f["stored_name"], 0) + 1
+        print(f"📒 Journal: restored {len(self._rooms)} rooms from {len(state)} snapshot rooms "
+              f"+ {len(records)} records in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def _restore_room(self, code, ts):
+        if code not in self._rooms:
+            self._rooms[code] = self._new_room(datetime.fromtimestamp(ts))
+
+    def _restore_files(self, code, records):
+        room = self._rooms.get(code)
+        if room is None:
+            return
+        for f_data in records:
+            # Idempotent: a record the snapshot already holds has a stale index
+            if f_data["index"] == len(room["files"]):
+                room["files"].append(f_data)
+                room["bytes"] += f_data.get("size_bytes", 0)
+
+    def _snapshot_state(self):
+        with self.lock:
+            live = list(self._rooms.items())
+        state = []
+        for i, (code, room) in enumerate(live):
+            with room["lock"]:
+                if not room["deleted"]:
+                    state.append([code, room["timestamp"].timestamp(), list(room["files"])])
+            if i % 1000 == 999:
+                eventlet.sleep(0)  # Changes made meanwhile are in the journal too
+        return state
+
+    def create_room(self, code, timestamp):
+        created = super().create_room(code, timestamp)
+        if created:
+            self.journal.append(["c", code, timestamp.timestamp()])
+        return created
+
+    def add_files(self, code, records, history_entry=None):
+        added = super().add_files(code, records, history_entry)
+        if added:
+            self.journal.append(["f", code, added])
+        return added
+
+    def delete_room(self, code):
+        removed = super().delete_room(code)
+        if removed is not None:
+            self.journal.append(["d", code])
+        return removed
+
+    def run_journal(self):
+        """Background task: write queued records, snapshot once the journal grows long.
+
+        The first pass compacts whatever was replayed at startup.
+        """
+        compact = self.journal.records_since_snapshot > 0
+        while True:
+            eventlet.sleep(JOURNAL_FLUSH_SECS)
+            try:
+                self.journal.flush()
+                if compact or self.journal.records_since_snapshot >= JOURNAL_SNAPSHOT_RECORDS:
+                    compact = False
+                    io_pool.run(self.journal.write_snapshot, self._snapshot_state())
+            except Exception as e:
+                print(f"Error writing room journal: {e}")
+
+def make_room_store(url):
+    """Build the room store selected by ROOM_STORE_URL."""
+    if url.startswith("sqlite:///"):
+        return SQLiteRoomStore(url[len("sqlite:///"):])
+    if url in ("", "memory://"):
+        if ROOM_JOURNAL_PATH:
+            return JournaledRoomStore(ROOM_JOURNAL_PATH)
+        return InMemoryRoomStore()
+    raise ValueError(f"Unsupported ROOM_STORE_URL: {url}")
+
+rooms = make_room_store(ROOM_STORE_URL)
+
+# Expiry scheduler state: the cleanup task sleeps until _next_wakeup unless woken early
+expiry_wakeup = threading.Event()
+_next_wakeup = None
+
+# ────────────────────────────────────────────────
+#  I/O EXECUTOR (KEEPS DISK I/O OFF THE EVENTLET HUB)
+# ────────────────────────────────────────────────
+
+class IOExecutor:
+    """Runs blocking filesystem calls on eventlet's native thread pool.
+
+    A green semaphore bounds the calls in flight to the pool size, so the
+    backlog waits cooperatively here, where it can be counted, instead of
+    piling up inside tpool.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        tpool.set_num_threads(size)
+        self._slots = eventlet.semaphore.Semaphore(size)
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def run(self, fn, *args, **kwargs):
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        with self._slots:
+            self.queued -= 1
+            self.active += 1
+            try:
+                return tpool.execute(fn, *args, **kwargs)
+            finally:
+                self.active -= 1
+                self.completed += 1
+
+    def stats(self):
+        return {"threads": self.size, "queued": self.queued, "active": self.active,
+                "completed": self.completed, "max_queued": self.max_queued}
+
+io_pool = IOExecutor(IO_THREADS)
+
+# ────────────────────────────────────────────────
+#  🆕 STORAGE QUOTAS & DISK WATERMARKS
+# ────────────────────────────────────────────────
+
+class StorageGovernor:
+    """Admission control for uploads, decided before any of the body is read.
+
+    Committed usage comes from the room store, so it is shared between
+    workers. Bytes of form uploads still being received are only known to
+    this process and are reserved here until the request finishes.
+    """
+
+    def __init__(self, room_quota, total_quota, high_watermark, low_watermark):
+        self.room_quota = room_quota
+        self.total_quota = total_quota
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._inflight = {}
+        self._inflight_total = 0
+        self.rejected = {"room_quota": 0, "storage_quota": 0, "disk": 0}
+        self.evicted = 0
+        # After an eviction pass that could not free enough, rejected uploads stop waking the
+        # cleanup task until this monotonic time
+        self.evict_backoff_until = 0.0
+
+    def disk_usage(self):
+        return shutil.disk_usage(UPLOAD_FOLDER)
+
+    def disk_used_fraction(self):
+        usage = self.disk_usage()
+        return usage.used / usage.total
+
+    def evict_stalled(self):
+        self.evict_backoff_until = time.monotonic() + EXPIRY_MAX_SLEEP_SECS
+
+    def admit(self, code, nbytes):
+        """Reserve `nbytes` for an upload into `code`.
+
+        Returns None when admitted (call release() afterwards), otherwise
+        (status, reason, message): 507 when the room is full, 503 when the
+        server as a whole is out of space.
+        """
+        if self.disk_used_fraction() >= self.high_watermark:
+            if time.monotonic() >= self.evict_backoff_until:
+                expiry_wakeup.set()  # Let the cleanup task evict rooms right away
+            return self._reject(503, "disk", "Server storage is full, please try again shortly")
+        if self.total_quota and rooms.stored_bytes() + self._inflight_total + nbytes > self.total_quota:
+            return self._reject(503, "storage_quota", "Server storage is full, please try again shortly")
+        if self.room_quota and rooms.stored_bytes(code) + self._inflight.get(code, 0) + nbytes > self.room_quota:
+            return self._reject(507, "room_quota",
+                                f"This room is full ({get_human_size(self.room_quota)} limit)")
+        self._inflight[code] = self._inflight.get(code, 0) + nbytes
+        self._inflight_total += nbytes
+        return None
+
+    def release(self, code, nbytes):
+        remaining = self._inflight.get(code, 0) - nbytes
+        if remaining > 0:
+            self._inflight[code] = remaining
+        else:
+            self._inflight.pop(code, None)
+        self._inflight_total -= nbytes
+
+    def _reject(self, status, reason, message):
+        self.rejected[reason] += 1
+        return status, reason, message
+
+    def stats(self):
+        return {"disk_used": round(self.disk_used_fraction(), 4),
+                "high_watermark": self.high_watermark, "low_watermark": self.low_watermark,
+                "inflight_bytes": self._inflight_total,
+                "rejected": dict(self.rejected), "evicted": self.evicted}
+
+storage = StorageGovernor(ROOM_QUOTA_BYTES, STORAGE_QUOTA_BYTES, DISK_HIGH_WATERMARK, DISK_LOW_WATERMARK)
+
+# ────────────────────────────────────────────────
+#  🆕 ROOM CODE ALLOCATOR
+# ────────────────────────────────────────────────
+
+class RoomCodeAllocator:
+    """Hands out room codes in constant time, without retrying taken codes.
+
+    Code n is a keyed Feistel permutation of a counter: every counter value
+    maps to a different code, and with a random key the sequence can't be
+    guessed from earlier codes. Once the counter has run through the whole
+    space, codes released by deleted rooms are reused, oldest first.
+
+    Only the newest `free_max` released codes are remembered. When older ones
+    had to be dropped and the free list runs dry, the counter starts another
+    pass over the space; codes still in use then come up as collisions.
+
+    The counter is per process, so codes of rooms restored after a restart or
+    created by another worker can still come up; create_room() rejects those
+    and the caller just takes the next code.
+    """
+
+    def __init__(self, digits, key=None, free_max=ROOM_CODE_FREE_MAX):
+        self.digits = digits
+        self.free_max = free_max
+        self.space = 10 ** digits
+        # Both Feistel halves range over [0, half); odd digit counts cycle-walk back into the space
+        self._half = 10 ** ((digits + 1) // 2)
+        key = key or secrets.token_bytes(32)
+        # Round function tables: F(i, x) only depends on one half, so it is computed up front
+        self._rounds = [[self._round_function(key, i, x) for x in range(self._half)]
+                        for i in range(ROOM_CODE_FEISTEL_ROUNDS)]
+        self._next = 0
+        self._free = OrderedDict()
+        self._dropped = 0  # Released codes forgotten since the current counter pass started
+        self._lock = threading.Lock()
+        self.passes = 1
+        self.recycled = 0
+        self.collisions = 0
+
+    def _round_function(self, key, i, value):
+        digest = hashlib.blake2b(value.to_bytes(8, "big"), digest_size=8,
+                                 key=key, salt=i.to_bytes(16, "big")).digest()
+        return int.from_bytes(digest, "big") % self._half
+
+    def _permute(self, n):
+        half = self._half
+        while True:
+            left, right = divmod(n, half)
+            for table in self._rounds:
+                left, right = right, (left + table[right]) % half
+            n = left * half + right
+            if n < self.space:
+                return n
+
+    def allocate(self):
+        """A code no room got from this allocator yet (or the oldest released one), None when all are in use."""
+        with self._lock:
+            if self._free and (self._next >= self.space or self.passes > 1):
+                self.recycled += 1
+                return self._free.popitem(last=False)[0]
+            if self._next >= self.space and self._dropped:
+                self._next, self._dropped = 0, 0
+                self.passes += 1
+            if self._next < self.space:
+                n, self._next = self._next, self._next + 1
+                return f"{self._permute(n):0{self.digits}d}"
+            return None
+
+    def release(self, code):
+        """Make the code of a deleted room available again."""
+        with self._lock:
+            self._free[code] = None
+            if len(self._free) > self.free_max:
+                self._free.popitem(last=False)
+                self._dropped += 1
+
+    def occupancy(self):
+        return rooms.room_count() / self.space
+
+    def stats(self):
+        return {"space": self.space, "issued": self._next, "free": len(self._free),
+                "dropped": self._dropped, "passes": self.passes, "recycled": self.recycled, "collisions": self.collisions,
+                "occupancy": round(self.occupancy(), 6)}
+
+room_codes = RoomCodeAllocator(ROOM_CODE_DIGITS)
+
+# ────────────────────────────────────────────────
+#  🆕 HOT FILE & ARCHIVE CACHE
+# ────────────────────────────────────────────────
+
+def _map_file(path):
+    """Read-only mmap of a whole file, paged in up front. Blocking: call through io_pool.
+
+    MAP_POPULATE faults the pages in on the I/O thread, so serving the map
+    later doesn't stall the hub on disk reads.
+    """
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0),
+                         prot=mmap.PROT_READ)
+
+class HotFileCache:
+    """Byte-budgeted LRU of read-only mmaps of downloaded blobs.
+
+    A blob is only mapped on its second request: one-off downloads go out via
+    sendfile, which doesn't copy the file through Python at all. Blobs are
+    content-addressed and never change, so an entry only has to go when its
+    blob is deleted. Evicted maps are not closed: responses still sending
+    from them keep them alive until they finish.
+    """
+
+    def __init__(self, max_bytes, max_file, candidates=FILE_CACHE_CANDIDATES):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.candidates = candidates
+        self._maps = OrderedDict()
+        # Blobs requested once so far, most recent last
+        self._seen = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest, size):
+        """The blob's mmap, or None when it shouldn't be cached (serve it from disk then)."""
+        mm = self._maps.get(digest)
+        if mm is not None:
+            self._maps.move_to_end(digest)
+            self.hits += 1
+            return mm
+        self.misses += 1
+        if not 0 < size <= min(self.max_file, self.max_bytes):
+            return None
+        if self._seen.pop(digest, None) is None:
+            self._seen[digest] = True
+            if len(self._seen) > self.candidates:
+                self._seen.popitem(last=False)
+            return None
+        try:
+            mm = io_pool.run(_map_file, Path(UPLOAD_FOLDER) / digest)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Another request may have mapped it while this one waited
+        if digest in self._maps:
+            return self._maps[digest]
+        self._maps[digest] = mm
+        self.bytes += len(mm)
+        while self.bytes > self.max_bytes:
+            _, old = self._maps.popitem(last=False)
+            self.bytes -= len(old)
+            self.evictions += 1
+        return mm
+
+    def discard(self, digest):
+        self._seen.pop(digest, None)
+        mm = self._maps.pop(digest, None)
+        if mm is not None:
+            self.bytes -= len(mm)
+
+    def stats(self):
+        return {"files": len(self._maps), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+class ArchiveCache:
+    """Finished download_all ZIPs, LRU by total bytes.
+
+    Keyed by room code and a digest of the archive's file list, so an
+    archive is never served for a different set of files even if
+    invalidation is missed (e.g. the room changed on another worker).
+    """
+
+    def __init__(self, max_bytes, max_archive):
+        self.max_bytes = max_bytes
+        self.max_archive = max_archive
+        self._archives = OrderedDict()
+        # Archives being built right now, shared by everyone who asks for them meanwhile
+        self._building = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    @staticmethod
+    def version(entries):
+        names = [(Path(path).name, arcname) for path, arcname in entries]
+        return hashlib.sha256(json.dumps(names).encode()).hexdigest()[:32]
+
+    def get(self, code, version):
+        body = self._archives.get((code, version))
+        if body is None:
+            self.misses += 1
+            return None
+        self._archives.move_to_end((code, version))
+        self.hits += 1
+        return body
+
+    def put(self, code, version, body):
+        if len(body) > min(self.max_archive, self.max_bytes) or (code, version) in self._archives:
+            return
+        self._archives[(code, version)] = body
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes:
+            _, old = self._archives.popitem(last=False)
+            self.bytes -= len(old)
+
+    def discard(self, code):
+        """Drop every archive of a room (its files changed or it is gone)."""
+        for key in [key for key in self._archives if key[0] == code]:
+            self.bytes -= len(self._archives.pop(key))
+        # Builds still running finish for their requesters but are not kept
+        for key in [key for key in self._building if key[0] == code]:
+            del self._building[key]
+
+    def build(self, code, version, entries):
+        """The ArchiveBuild for this archive, started by the first requester."""
+        key = (code, version)
+        build = self._building.get(key)
+        if build is not None:
+            self.joined += 1
+            return build
+        build = self._building[key] = ArchiveBuild()
+        eventlet.spawn(self._run_build, key, build, entries)
+        return build
+
+    def _run_build(self, key, build, entries):
+        started = time.perf_counter()
+        try:
+            for chunk in stream_zip(entries):
+                build.add(chunk)
+        except Exception as e:
+            print(f"Error building archive for room {key[0]}: {e}")
+            build.finish(failed=True)
+            return
+        finally:
+            if self._building.get(key) is build:
+                del self._building[key]
+            else:
+                build.discarded = True
+        metrics.zip_builds.observe(time.perf_counter() - started)
+        if not build.discarded:
+            self.put(*key, b"".join(build.chunks))
+        build.finish()
+
+    def stats(self):
+        return {"archives": len(self._archives), "bytes": self.bytes, "building": len(self._building),
+                "hits": self.hits, "misses": self.misses, "joined": self.joined}
+
+class ArchiveBuild:
+    """One "download all" ZIP built once for every concurrent requester.
+
+    The build runs in its own green thread and keeps every chunk, so there
+    is one copy in memory however many people wait for it. Requesters
+    arriving mid-build replay the chunks so far and then follow along.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self.discarded = False
+        self._changed = threading.Condition()
+
+    def add(self, chunk):
+        with self._changed:
+            self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    def finish(self, failed=False):
+        with self._changed:
+            self.done = True
+            self.failed = failed
+            self._changed.notify_all()
+
+    def follow(self):
+        """Response body: every chunk of the archive, as soon as it is built."""
+        sent = 0
+        while True:
+            with self._changed:
+                while sent == len(self.chunks) and not self.done:
+                    self._changed.wait()
+                chunks = self.chunks[sent:]
+                finished = self.done
+            for chunk in chunks:
+                metrics.bytes_downloaded += len(chunk)
+                yield chunk
+            sent += len(chunks)
+            if finished and sent == len(self.chunks):
+                if self.failed:
+                    raise IOError("archive build failed")
+                return
+
+hot_files = HotFileCache(FILE_CACHE_BYTES, FILE_CACHE_MAX_FILE)
+archive_cache = ArchiveCache(ARCHIVE_CACHE_BYTES, ARCHIVE_CACHE_MAX_ARCHIVE)
+
+def iter_mapped(mm):
+    """Response body from an mmap. WSGI servers want bytes, so each chunk is a
+    memory copy, which is still far cheaper than a read from disk."""
+    for start in range(0, len(mm), IO_CHUNK_SIZE):
+        yield mm[start:start + IO_CHUNK_SIZE]
+
+# ────────────────────────────────────────────────
+#  🆕 BANDWIDTH SHAPING
+# ────────────────────────────────────────────────
+
+class TokenBucket:
+    """Bytes/second limit that allows bursts of up to `capacity` bytes.
+
+    take() may drive the balance negative; the caller then sleeps until it
+    is paid back. Every stream sharing the bucket queues behind that debt,
+    so with equal step sizes they get equal shares.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, nbytes, now):
+        """Spend `nbytes`; returns how many seconds to wait before using them."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class BandwidthShaper:
+    """Per-user and per-room token buckets for request and response bodies.
+
+    Each step is charged to both the user's and the room's bucket and waits
+    for the slower of the two, so one user can't starve the rest of their
+    room, and one room can't starve the other rooms on this worker.
+    """
+
+    def __init__(self, user_rate, room_rate, burst_secs):
+        self.user_rate = user_rate
+        self.room_rate = room_rate
+        self.burst_secs = burst_secs
+        self._users = {}
+        self._rooms = {}
+        self.throttled = {"upload": 0, "download": 0}
+        self.throttled_seconds = {"upload": 0.0, "download": 0.0}
+
+    @property
+    def enabled(self):
+        return bool(self.user_rate or self.room_rate)
+
+    def _bucket(self, buckets, key, rate):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, rate * self.burst_secs)
+        return bucket
+
+    def throttle(self, user, code, nbytes, direction):
+        """Charge `nbytes` and sleep (this green thread only) until they are within the limits."""
+        now = time.monotonic()
+        delay = 0.0
+        if self.user_rate:
+            delay = self._bucket(self._users, user, self.user_rate).take(nbytes, now)
+        if self.room_rate and code:
+            delay = max(delay, self._bucket(self._rooms, code, self.room_rate).take(nbytes, now))
+        if delay > 0:
+            self.throttled[direction] += 1
+            self.throttled_seconds[direction] += delay
+            eventlet.sleep(delay)
+
+    def shaped_body(self, body, user, code):
+        """Response iterable re-cut into SHAPING_CHUNK_SIZE steps and paced by throttle()."""
+        try:
+            for chunk in body:
+                for start in range(0, len(chunk), SHAPING_CHUNK_SIZE):
+                    piece = chunk[start:start + SHAPING_CHUNK_SIZE] if len(chunk) > SHAPING_CHUNK_SIZE else chunk
+                    self.throttle(user, code, len(piece), "download")
+                    yield piece
+        finally:
+            # The WSGI server closes this generator; pass that on (file handles, pipe readers)
+            close = getattr(body, "close", None)
+            if close:
+                close()
+
+    def prune(self):
+        """Forget buckets that have refilled; a new one starts full, so nothing changes."""
+        now = time.monotonic()
+        for buckets in (self._users, self._rooms):
+            for key in [key for key, bucket in buckets.items() if bucket.idle(now)]:
+                del buckets[key]
+
+    def stats(self):
+        return {"user_rate": self.user_rate, "room_rate": self.room_rate,
+                "active_users": len(self._users), "active_rooms": len(self._rooms),
+                "throttled": dict(self.throttled),
+                "throttled_seconds": {k: round(v, 3) for k, v in self.throttled_seconds.items()}}
+
+class ShapedInput:
+    """wsgi.input wrapper whose reads are paced by the bandwidth shaper."""
+
+    def __init__(self, stream, user, code):
+        self._stream = stream
+        self._user = user
+        self._code = code
+
+    def _paced(self, data):
+        if data:
+            shaper.throttle(self._user, self._code, len(data), "upload")
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._paced(self._stream.read())
+        return self._paced(self._stream.read(min(size, SHAPING_CHUNK_SIZE)))
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = SHAPING_CHUNK_SIZE
+        return self._paced(self._stream.readline(min(size, SHAPING_CHUNK_SIZE)))
+
+shaper = BandwidthShaper(USER_BANDWIDTH_BPS, ROOM_BANDWIDTH_BPS, BANDWIDTH_BURST_SECS)
+
+SHAPED_UPLOADS = {"upload_file", "upload_chunk", "upload_pipe"}
+SHAPED_DOWNLOADS = {"download_file", "download_all", "download_pipe"}
+
+def shaping_key():
+    """Who to charge: the user_id cookie, or the client address before one is set."""
+    return request.cookies.get("user_id") or request.remote_addr
+
+@app.before_request
+def shape_upload():
+    # Replaced before anything touches request.stream or request.files
+    if request.endpoint in SHAPED_UPLOADS and shaper.enabled:
+        request.environ["wsgi.input"] = ShapedInput(request.environ["wsgi.input"], shaping_key(),
+                                                    request.view_args.get("code"))
+
+@app.after_request
+def shape_download(response):
+    if (request.endpoint in SHAPED_DOWNLOADS and shaper.enabled and request.method == "GET"
+            and response.status_code in (200, 206)):
+        response.response = shaper.shaped_body(response.response, shaping_key(),
+                                               request.view_args.get("code"))
+    return response
+
+# ────────────────────────────────────────────────
+#  UTILITY FUNCTIONS
+# ────────────────────────────────────────────────
+
+def get_human_size(bytes_size):
+    """Convert bytes to human-readable format."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if bytes_size < 1024:
+            return f"{bytes_size:.1f} {unit}"
+        bytes_size /= 1024
+    return f"{bytes_size:.1f} TB"
+
+def get_or_create_user():
+    """Get user ID from cookie or create a new one."""
+    user_id = request.cookies.get('user_id')
+    if not user_id:
+        user_id = f"user_{int(time.time())}_{random.randint(1000, 9999)}"
+    return user_id
+
+def make_history_entry(user, action):
+    return HistoryEntry(user, action)
+
+def add_history(code, user, action):
+    """Add an action to room history (Thread Safe). Returns False if the room is gone."""
+    return rooms.add_history(code, make_history_entry(user, action))
+
+def make_file_record(orig_name, stored_name, size_bytes, user):
+    """Build the file entry kept in the room store and sent to clients."""
+    return {
+        "original_name": orig_name,
+        "stored_name": stored_name,
+        "size": get_human_size(size_bytes),
+        "size_bytes": size_bytes,
+        "type": orig_name.split('.')[-1].upper() if '.' in orig_name else "FILE",
+        "sender": user
+    }
+
+def publish_files(code, user, file_records):
+    """Append stored files to a room, log history and notify clients."""
+    uploaded_files = rooms.add_files(code, file_records,
+                                     make_history_entry(user, f"sent {len(file_records)} file(s)"))
+    if uploaded_files:
+        archive_cache.discard(code)
+        event_batcher.new_files(code, uploaded_files, user)
+    return uploaded_files
+
+def delete_upload_files(filenames):
+    """Delete plain (non-blob) files from the upload folder."""
+    for filename in filenames:
+        try:
+            io_pool.run((Path(UPLOAD_FOLDER) / filename).unlink, missing_ok=True)
+        except Exception as e:
+            print(f"Error deleting file {filename}: {e}")
+
+def new_part_name():
+    """Unique temporary file name for an upload that has not been hashed yet."""
+    return f".part_{secrets.token_hex(12)}"
+
+def commit_blob(part_name, digest):
+    """Move a fully written upload into blob storage and take a reference to it.
+
+    If the same content is already stored, the new copy is simply discarded.
+    """
+    part_path = Path(UPLOAD_FOLDER) / part_name
+    rooms.incref_blob(digest, lambda: io_pool.run(os.replace, part_path, Path(UPLOAD_FOLDER) / digest))
+    # Already stored (or just moved into place): the part file is no longer needed
+    io_pool.run(part_path.unlink, missing_ok=True)
+    return digest
+
+def _hash_and_write(hasher, out, chunk):
+    hasher.update(chunk)
+    out.write(chunk)
+
+def _hash_write_flush(hasher, out, chunk):
+    # Flushed so other file descriptors (pipe receivers) can read it right away
+    _hash_and_write(hasher, out, chunk)
+    out.flush()
+
+class PartWriter:
+    """Destination of one file in a multipart form upload.
+
+    Werkzeug's form parser hands each piece of the file to write() while it
+    reads the request body (on the hub, it is a green socket). Pieces are
+    gathered up to IO_CHUNK_SIZE, then hashed and written into a part file
+    on the I/O pool, so the upload never goes through a spooled temp file
+    that the hub would write and read back.
+    """
+
+    def __init__(self):
+        self.part_name = new_part_name()
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+        self._pending = []
+        self._pending_bytes = 0
+        self._out = io_pool.run(open, Path(UPLOAD_FOLDER) / self.part_name, "wb")
+
+    def write(self, data):
+        self._pending.append(bytes(data))
+        self._pending_bytes += len(data)
+        self.size += len(data)
+        metrics.bytes_uploaded += len(data)
+        if self._pending_bytes >= IO_CHUNK_SIZE:
+            self._flush()
+        return len(data)
+
+    def _flush(self):
+        if self._pending:
+            chunk = b"".join(self._pending)
+            self._pending, self._pending_bytes = [], 0
+            io_pool.run(_hash_and_write, self.hasher, self._out, chunk)
+
+    def seek(self, offset, whence=0):
+        # The parser rewinds the container once the file is complete
+        self.close()
+        return 0
+
+    def close(self):
+        if self._out is None:
+            return
+        try:
+            self._flush()
+        finally:
+            io_pool.run(self._out.close)
+            self._out = None
+
+    def commit(self):
+        """Move the finished file into blob storage. Returns (digest, size)."""
+        self.close()
+        digest = commit_blob(self.part_name, self.hasher.hexdigest())
+        self.committed = True
+        return digest, self.size
+
+    def discard(self):
+        """Delete the part file unless it was committed (aborted or rejected upload)."""
+        if self.committed:
+            return
+        try:
+            self.close()
+        except Exception as e:
+            print(f"Error closing upload part {self.part_name}: {e}")
+        delete_upload_files([self.part_name])
+
+class UploadRequest(Request):
+    """Request whose form files for upload_file are parsed straight into PartWriters."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_parts = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != "upload_file":
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        part = PartWriter()
+        self.upload_parts.append(part)
+        return part
+
+app.request_class = UploadRequest
+
+def hash_file(path):
+    """SHA-256 of a file on disk, read in chunks. Blocking: call through io_pool."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(IO_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def delete_blob(digest):
+    hot_files.discard(digest)
+    io_pool.run((Path(UPLOAD_FOLDER) / digest).unlink, missing_ok=True)
+
+def release_blobs(digests):
+    """Drop one reference per digest and delete blobs nobody points at anymore."""
+    for digest in digests:
+        try:
+            rooms.decref_blob(digest, lambda: delete_blob(digest))
+        except Exception as e:
+            print(f"Error deleting file {digest}: {e}")
+
+def forget_room(code):
+    """Drop what this process keeps about a deleted room: its code and cached archives."""
+    room_codes.release(code)
+    archive_cache.discard(code)
+
+class _ZipStreamSink:
+    """Write-only, non-seekable target for ZipFile that hands bytes back to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+def _zip_copy_chunk(src, dest):
+    chunk = src.read(ZIP_CHUNK_SIZE)
+    if chunk:
+        dest.write(chunk)
+    return bool(chunk)
+
+def stream_zip(entries):
+    """Yield a ZIP archive of (path, arcname) entries chunk by chunk.
+
+    The sink is not seekable, so zipfile writes data descriptors after each
+    entry and switches to ZIP64 on its own for large files. Memory stays at
+    roughly one chunk no matter how big the room is.
+    """
+    sink = _ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for file_path, arcname in entries:
+            zinfo = io_pool.run(zipfile.ZipInfo.from_file, file_path, arcname)
+            ext = arcname.rsplit('.', 1)[-1].lower() if '.' in arcname else ""
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+            src = io_pool.run(open, file_path, 'rb')
+            try:
+                with zf.open(zinfo, 'w') as dest:
+                    yield from sink.drain()  # local file header
+                    # Read + deflate happen on the I/O pool, the hub only forwards bytes
+                    while io_pool.run(_zip_copy_chunk, src, dest):
+                        yield from sink.drain()
+            finally:
+                io_pool.run(src.close)
+            yield from sink.drain()  # data descriptor
+    yield from sink.drain()  # central directory
+
+def metered_zip(entries):
+    """stream_zip() that counts bytes sent and records the build time.
+
+    The archive is produced as fast as the client reads it, so the time
+    includes the transfer; abandoned downloads are not recorded.
+    """
+    started = time.perf_counter()
+    for chunk in stream_zip(entries):
+        metrics.bytes_downloaded += len(chunk)
+        yield chunk
+    metrics.zip_builds.observe(time.perf_counter() - started)
+
+def sweep_expired_rooms(now=None):
+    """Delete every room whose deadline has passed. Returns the number removed."""
+    now = now or datetime.now()
+    expired_files = []
+    expired_parts = []
+    removed_count = 0
+
+    # delete_room is atomic, so with several workers sweeping only one of them removes a given room
+    for code in rooms.expired_rooms(now - timedelta(minutes=ROOM_DURATION_MINS)):
+        removed = rooms.delete_room(code)
+        if removed is None:
+            continue
+        removed_count += 1
+        metrics.rooms_expired += 1
+        forget_room(code)
+        expired_files.extend(f["stored_name"] for f in removed["files"])
+        expired_parts.extend(removed["parts"])
+        # 🟢 FIX: Notify clients that room is destroyed
+        socketio.emit('room_destroyed', {}, to=code)
+        print(f"🧹 Cleanup: Auto-deleted expired room {code}")
+
+    # Delete files from disk
+    release_blobs(expired_files)
+    delete_upload_files(expired_parts)
+    return removed_count
+
+def evict_for_disk_space():
+    """Above the high disk watermark: delete the oldest rooms until usage is under the low one.
+
+    Only rooms older than DISK_EVICT_MIN_AGE_SECS that give disk space back are
+    candidates, and only if together they can bring usage under the low
+    watermark. Space held by anything else (logs, other programs) can't be
+    won back by deleting rooms, so then uploads are just refused. Stops as
+    soon as an eviction does not lower usage.
+    """
+    usage = storage.disk_usage()
+    if usage.used < storage.high_watermark * usage.total or time.monotonic() < storage.evict_backoff_until:
+        return 0
+    target = storage.low_watermark * usage.total
+    cutoff = datetime.now() - timedelta(seconds=DISK_EVICT_MIN_AGE_SECS)
+    candidates = []
+    for code in rooms.oldest_rooms(cutoff):
+        freeable = rooms.freeable_bytes(code)
+        if freeable:
+            candidates.append(code)
+            target += freeable
+        if target >= usage.used:
+            break
+    if target < usage.used:
+        storage.evict_stalled()
+        print("💾 Disk full: evicting rooms can't free enough, refusing uploads instead")
+        return 0
+
+    evicted = 0
+    used = usage.used
+    for code in candidates:
+        removed = rooms.delete_room(code)
+        if removed is None:
+            continue
+        release_blobs(f["stored_name"] for f in removed["files"])
+        delete_upload_files(removed["parts"])
+        forget_room(code)
+        socketio.emit('room_destroyed', {}, to=code)
+        evicted += 1
+        print(f"💾 Disk full: evicted room {code} early")
+        usage = storage.disk_usage()
+        if usage.used < storage.low_watermark * usage.total:
+            break
+        if usage.used >= used:
+            # Files still open elsewhere, or something else is filling the disk
+            storage.evict_stalled()
+            break
+        used = usage.used
+    storage.evicted += evicted
+    return evicted
+
+def upload_retry_after():
+    """Seconds until the next room expires and frees space (for Retry-After)."""
+    oldest = rooms.next_expiry()
+    if oldest is None:
+        return EXPIRY_MAX_SLEEP_SECS
+    remaining = (oldest + timedelta(minutes=ROOM_DURATION_MINS) - datetime.now()).total_seconds()
+    return max(5, int(remaining) + 1)
+
+def rejection_headers(status):
+    """A full server frees space as rooms expire, so 503s say when to come back."""
+    return {"Retry-After": str(upload_retry_after())} if status == 503 else {}
+
+def is_upload_file_name(name):
+    """True for names this app creates in UPLOAD_FOLDER: blobs (SHA-256 hex) and part files."""
+    return bool(BLOB_NAME_RE.fullmatch(name)) or name.startswith(".part_")
+
+def _remove_unreferenced(keep, cutoff):
+    """Delete blobs and part files in UPLOAD_FOLDER not in `keep` and older than `cutoff`. Blocking.
+
+    Anything else (a journal, a database, notes) is left alone, even if it sits in the folder.
+    """
+    removed = freed = 0
+    with os.scandir(UPLOAD_FOLDER) as it:
+        for entry in it:
+            if entry.name in keep or not is_upload_file_name(entry.name) or not entry.is_file(follow_symlinks=False):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if st.st_mtime >= cutoff:
+                continue
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += st.st_size
+    return removed, freed
+
+def reclaim_orphan_files():
+    """Background task: after a restart, delete uploads that no room references anymore.
+
+    Runs once at startup and once more after RECLAIM_GRACE_SECS, to also catch
+    files that were too new to judge the first time.
+    """
+    for delay in (0, RECLAIM_GRACE_SECS):
+        eventlet.sleep(delay)
+        try:
+            keep = rooms.referenced_files()
+            removed, freed = io_pool.run(_remove_unreferenced, keep, time.time() - RECLAIM_GRACE_SECS)
+            if removed:
+                print(f"🧹 Reclaimed {removed} orphaned file(s), {get_human_size(freed)}")
+        except Exception as e:
+            print(f"Error reclaiming orphaned files: {e}")
+
+def schedule_expiry(deadline):
+    """Wake the cleanup task early if `deadline` comes before its planned wake-up."""
+    if _next_wakeup is None or deadline < _next_wakeup:
+        expiry_wakeup.set()
+
+def cleanup_expired_rooms():
+    """Background task: sleep until the next room deadline, then remove only the due rooms."""
+    global _next_wakeup
+    while True:
+        try:
+            now = datetime.now()
+            oldest = rooms.next_expiry()
+            # Cap the sleep so rooms created by other workers are still picked up on time
+            _next_wakeup = now + timedelta(seconds=EXPIRY_MAX_SLEEP_SECS)
+            if oldest is not None:
+                _next_wakeup = min(_next_wakeup, oldest + timedelta(minutes=ROOM_DURATION_MINS))
+
+            timeout = (_next_wakeup - now).total_seconds()
+            if timeout > 0:
+                expiry_wakeup.wait(timeout)
+            expiry_wakeup.clear()
+
+            started = time.perf_counter()
+            sweep_expired_rooms()
+            metrics.cleanup_sweeps.observe(time.perf_counter() - started)
+            evict_for_disk_space()
+            shaper.prune()
+        except Exception as e:
+            print(f"Error in cleanup loop: {e}")
+            eventlet.sleep(1)
+
+# ────────────────────────────────────────────────
+#  SOCKET.IO EVENT BATCHING
+# ────────────────────────────────────────────────
+
+def batch_room(code):
+    """Socket.IO room for clients that understand batched 'room_events'."""
+    return f"{code}:batch"
+
+def legacy_room(code):
+    """Socket.IO room for clients that only handle individual events."""
+    return f"{code}:legacy"
+
+class RoomEventBatcher:
+    """Coalesces new_files and file_downloaded events per room over a short window.
+
+    The first event for a room schedules a flush `window` seconds later;
+    everything queued until then goes out as one 'room_events' frame to
+    batch-aware clients. Older clients get the same information as plain
+    'new_files' (one per sender) and 'file_downloaded' (one per file) events.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.events_in = 0
+        self.frames_out = 0
 
-# 🟢 CONFIG: Using 'eventlet' for async mode (Required for Render)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+    def _queue(self, code):
+        batch = self._pending.get(code)
+        if batch is None:
+            batch = self._pending[code] = {"new_files": [], "downloads": {}}
+            eventlet.spawn_after(self.window, self.flush, code)
+        return batch
 
-UPLOAD_FOLDER = "uploads"
-ROOM_DURATION_MINS = 15
+    def new_files(self, code, files, sender):
+        if self.window <= 0:
+            self.frames_out += 1
+            return socketio.emit('new_files', {'files': files, 'sender': sender}, to=code)
+        with self._lock:
+            self.events_in += 1
+            self._queue(code)["new_files"].append({'files': files, 'sender': sender})
 
-# Ensure upload directory exists
-Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
+    def file_downloaded(self, code, filename, user):
+        if self.window <= 0:
+            self.frames_out += 1
+            return socketio.emit('file_downloaded', {'filename': filename, 'user': user}, to=code)
+        with self._lock:
+            self.events_in += 1
+            downloads = self._queue(code)["downloads"]
+            entry = downloads.setdefault(filename, {'filename': filename, 'users': [], 'count': 0})
+            entry['count'] += 1
+            if user not in entry['users']:
+                entry['users'].append(user)
 
-# ────────────────────────────────────────────────
-#  IN-MEMORY STORAGE & LOCKING
-# ────────────────────────────────────────────────
+    def flush(self, code):
+        with self._lock:
+            batch = self._pending.pop(code, None)
+        if not batch:
+            return
+        downloads = list(batch["downloads"].values())
+
+        socketio.emit('room_events', {
+            'new_files': batch["new_files"],
+            'downloads': downloads
+        }, to=batch_room(code))
+
+        for upload in batch["new_files"]:
+            socketio.emit('new_files', upload, to=legacy_room(code))
+        for entry in downloads:
+            socketio.emit('file_downloaded', {
+                'filename': entry['filename'],
+                'user': entry['users'][-1]
+            }, to=legacy_room(code))
+        self.frames_out += 1 + len(batch["new_files"]) + len(downloads)
+
+    def stats(self):
+        return {"window_ms": int(self.window * 1000), "events_in": self.events_in,
+                "frames_out": self.frames_out, "pending_rooms": len(self._pending)}
 
-room_store = {}
-# 🟢 LOCK: Prevents crashes when multiple users access/delete rooms simultaneously
-room_lock = threading.Lock()
+event_batcher = RoomEventBatcher(EVENT_BATCH_WINDOW_MS / 1000)
 
 # ────────────────────────────────────────────────
-#  UTILITY FUNCTIONS
+#  🆕 LIVE PIPE RELAY (UPLOAD → WAITING DOWNLOADERS)
 # ────────────────────────────────────────────────
 
-def generate_code():
-    """Generate a unique 6-digit code for the room."""
-    with room_lock:
+class Pipe:
+    """An upload in progress whose bytes are teed to receivers as they arrive.
+
+    The sender appends each chunk to a bounded in-memory buffer, then writes it
+    to the part file. Chunks leave the buffer once they are on disk and every
+    attached receiver has sent them on. When the buffer is full the sender waits
+    for the slowest receiver (backpressure) for up to PIPE_STALL_SECS. After
+    that the oldest chunks are dropped anyway, and receivers behind them read
+    from the part file, which also serves anyone who joins late.
+    """
+
+    def __init__(self, pipe_id, code, filename, size, part_name, user, capacity):
+        self.id = pipe_id
+        self.code = code
+        self.filename = filename
+        self.size = size
+        self.part_name = part_name
+        self.user = user
+        self.capacity = capacity
+        self.chunks = deque()  # (offset, bytes)
+        self.buffered = 0
+        self.received = 0
+        self.on_disk = 0
+        self.readers = {}      # reader id -> bytes sent
+        self.done = False
+        self.failed = False
+        self.retired = False
+        self.file_index = None
+        self.read_fd = None
+        self._next_reader = 0
+        self.cond = threading.Condition()
+
+    @property
+    def buffer_start(self):
+        return self.chunks[0][0] if self.chunks else self.received
+
+    def _evict(self, force=False):
+        slowest = min(self.readers.values(), default=self.received)
+        while self.chunks:
+            offset, data = self.chunks[0]
+            end = offset + len(data)
+            if end > self.on_disk or (end > slowest and not force):
+                break
+            self.chunks.popleft()
+            self.buffered -= len(data)
+
+    def push(self, chunk):
+        """Append a chunk, waiting (bounded) while slow receivers keep the buffer full."""
+        with self.cond:
+            self._evict()
+            deadline = time.monotonic() + PIPE_STALL_SECS
+            while self.buffered + len(chunk) > self.capacity:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._evict(force=True)  # Laggards fall back to the part file
+                    break
+                self.cond.wait(remaining)
+                self._evict()
+            self.chunks.append((self.received, chunk))
+            self.buffered += len(chunk)
+            self.received += len(chunk)
+            self.cond.notify_all()
+
+    def written(self, nbytes):
+        with self.cond:
+            self.on_disk += nbytes
+            self._evict()
+
+    def finish(self, failed=False):
+        with self.cond:
+            self.done = True
+            self.failed = failed
+            self.cond.notify_all()
+
+    def retire(self):
+        with self.cond:
+            self.retired = True
+            self._maybe_close()
+
+    def _maybe_close(self):
+        # The part file may already be renamed or deleted; the descriptor still reads it
+        if self.retired and not self.readers and self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+    def attach(self):
+        with self.cond:
+            reader = self._next_reader
+            self._next_reader += 1
+            self.readers[reader] = 0
+            return reader
+
+    def detach(self, reader):
+        with self.cond:
+            self.readers.pop(reader, None)
+            self.cond.notify_all()
+            self._maybe_close()
+
+    def stream(self, reader):
+        """Yield the upload from the start, from memory where possible, else from disk.
+
+        Stops early (short of `size`) if the sender fails.
+        """
+        pos = 0
         while True:
-            code = ''.join([str(random.randint(0, 9)) for _ in range(6)])
-            if code not in room_store:
-                return code
+            with self.cond:
+                while pos >= self.received and not self.done:
+                    self.cond.wait()
+                if self.failed or pos >= self.received:
+                    return
+                if pos >= self.buffer_start:
+                    for offset, data in self.chunks:
+                        if offset <= pos < offset + len(data):
+                            chunk = data if offset == pos else data[pos - offset:]
+                            break
+                    source = "memory"
+                else:
+                    # Evicted already, but everything before buffer_start is on disk
+                    length = min(self.buffer_start, pos + PIPE_CHUNK_SIZE) - pos
+                    source = "disk"
+            if source == "disk":
+                chunk = io_pool.run(os.pread, self.read_fd, length, pos)
+                if not chunk:
+                    return
+            metrics.pipe_bytes[source] += len(chunk)
+            yield chunk
+            pos += len(chunk)
+            with self.cond:
+                self.readers[reader] = pos
+                self.cond.notify_all()
 
-def get_human_size(bytes_size):
-    """Convert bytes to human-readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_size < 1024:
-            return f"{bytes_size:.1f} {unit}"
-        bytes_size /= 1024
-    return f"{bytes_size:.1f} TB"
+class PipeRegistry:
+    """Pipes of this worker by id. Finished pipes linger so late links still resolve."""
 
-def get_or_create_user():
-    """Get user ID from cookie or create a new one."""
-    user_id = request.cookies.get('user_id')
-    if not user_id:
-        user_id = f"user_{int(time.time())}_{random.randint(1000, 9999)}"
-    return user_id
+    def __init__(self):
+        self._pipes = {}
 
-def add_history(code, user, action):
-    """Add an action to room history (Thread Safe)."""
-    with room_lock:
-        if code in room_store:
-            room_store[code]["history"].append({
-                "user": user,
-                "action": action,
-                "time": datetime.now().strftime("%H:%M:%S")
-            })
+    def open(self, code, filename, size, user):
+        pipe = Pipe(secrets.token_urlsafe(12), code, filename, size, new_part_name(), user, PIPE_BUFFER_BYTES)
+        path = Path(UPLOAD_FOLDER) / pipe.part_name
+        io_pool.run(path.touch)
+        pipe.read_fd = io_pool.run(os.open, path, os.O_RDONLY)
+        self._pipes[pipe.id] = pipe
+        return pipe
 
-def cleanup_expired_rooms():
-    """Background task to delete expired rooms and their files."""
-    while True:
-        eventlet.sleep(60)  # Check every minute
-        try:
-            now = datetime.now()
-            expired_files = []
-            expired_rooms = []
-            
-            # Identify expired items safely
-            with room_lock:
-                for code, data in list(room_store.items()):
-                    if (now - data["timestamp"]) > timedelta(minutes=ROOM_DURATION_MINS):
-                        expired_rooms.append(code)
-                        for file_info in data["files"]:
-                            expired_files.append(file_info["stored_name"])
-                
-                # Remove from memory AND Notify users
-                for code in expired_rooms:
-                    # 🟢 FIX: Notify clients that room is destroyed
-                    socketio.emit('room_destroyed', {}, to=code)
-                    if code in room_store:
-                        del room_store[code]
-                        print(f"🧹 Cleanup: Auto-deleted expired room {code}")
-
-            # Delete files from disk (Outside lock to allow other operations)
-            for filename in expired_files:
-                try:
-                    file_path = Path(UPLOAD_FOLDER) / filename
-                    if file_path.exists():
-                        file_path.unlink()
-                except Exception as e:
-                    print(f"Error deleting file {filename}: {e}")
-                    
-        except Exception as e:
-            print(f"Error in cleanup loop: {e}")
+    def get(self, pipe_id):
+        return self._pipes.get(pipe_id)
+
+    def retire(self, pipe):
+        eventlet.spawn_after(PIPE_LINGER_SECS, self._remove, pipe)
+
+    def _remove(self, pipe):
+        self._pipes.pop(pipe.id, None)
+        pipe.retire()
+
+    def stats(self):
+        active = [p for p in self._pipes.values() if not p.done]
+        return {"active": len(active), "receivers": sum(len(p.readers) for p in active),
+                "buffered_bytes": sum(p.buffered for p in active),
+                "relayed_bytes": dict(metrics.pipe_bytes)}
+
+pipes = PipeRegistry()
+
+def attachment_header(filename):
+    """Content-Disposition for any file name (ASCII fallback plus RFC 5987 UTF-8 form)."""
+    fallback = filename.encode("ascii", "ignore").decode().replace('"', "").replace("\\", "") or "download"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
 
 # ────────────────────────────────────────────────
 #  SOCKET.IO EVENTS
 # ────────────────────────────────────────────────
 
+@socketio.on('connect')
+def handle_connect(auth=None):
+    metrics.socket_connections += 1
+
+def room_listener_count(code):
+    """Socket.IO clients of this worker currently in the room."""
+    return len(socketio.server.manager.rooms.get('/', {}).get(code, {}))
+
+def announce_presence(code, count, **kwargs):
+    """Tell the room how many people have it open (senders pipe uploads live when others wait).
+
+    Counts are per worker, so nothing is sent when live pipes are off.
+    """
+    if LIVE_PIPES_ENABLED:
+        emit('room_presence', {'count': count}, to=code, **kwargs)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    metrics.socket_connections -= 1
+    for room in socket_rooms():
+        if room.endswith(":p2p"):
+            emit('p2p_peer_left', {'peer': request.sid}, to=room, include_self=False)
+        elif room.isdigit():
+            # Still counted as a member while this handler runs
+            announce_presence(room, room_listener_count(room) - 1, include_self=False)
+
 @socketio.on('join')
 def handle_join(data):
     code = data.get('code')
-    exists = False
-    with room_lock:
-        exists = code in room_store
-
-    if code and exists:
+    if code and rooms.room_exists(code):
         join_room(code)
+        # Clients that send batch=true get coalesced 'room_events' instead of single events
+        join_room(batch_room(code) if data.get('batch') else legacy_room(code))
+        # 🆕 P2P: Members already in the room open a WebRTC connection to the newcomer
+        if data.get('p2p') and P2P_ENABLED:
+            join_room(p2p_room(code))
+            join_room(p2p_peer_room(code, request.sid))
+            emit('p2p_peer_joined', {'peer': request.sid, 'user': get_or_create_user()},
+                 to=p2p_room(code), include_self=False)
+        # 🆕 PRESENCE: Senders stream uploads live (pipe mode) when someone is waiting
+        announce_presence(code, room_listener_count(code))
         print(f"User joined room: {code}")
 
 @socketio.on('leave')
@@ -133,26 +2652,233 @@ def handle_leave(data):
     code = data.get('code')
     if code:
         leave_room(code)
+        leave_room(batch_room(code))
+        leave_room(legacy_room(code))
+        if p2p_room(code) in socket_rooms():
+            leave_room(p2p_room(code))
+            leave_room(p2p_peer_room(code, request.sid))
+            emit('p2p_peer_left', {'peer': request.sid}, to=p2p_room(code))
+        announce_presence(code, room_listener_count(code))
         print(f"User left room: {code}")
 
+# ────────────────────────────────────────────────
+#  🆕 NEW: WEBRTC SIGNALING (P2P MODE)
+# ────────────────────────────────────────────────
+#  1. A browser joins with {code, p2p: true}; peers already there get 'p2p_peer_joined'
+#  2. Each of them sends an 'offer' to the newcomer, which replies with an 'answer'
+#  3. Both sides trickle 'candidate's until a direct data channel is up
+#  File bytes then flow browser to browser; the server never sees them.
+
+P2P_SIGNAL_TYPES = {"offer", "answer", "candidate"}
+# SDP with many candidates is a few KB; anything far bigger is not signaling
+P2P_SIGNAL_MAX_BYTES = 64 * 1024
+
+def p2p_room(code):
+    """Socket.IO room for clients taking part in peer-to-peer transfers."""
+    return f"{code}:p2p"
+
+def p2p_peer_room(code, sid):
+    """Socket.IO room holding only `sid`, and only while it is in the room's P2P group.
+
+    Signals are emitted to this room instead of to the bare sid, so they can
+    only reach a peer of the same room, on whichever worker it is connected.
+    """
+    return f"{code}:p2p:{sid}"
+
+@socketio.on('p2p_signal')
+def handle_p2p_signal(data):
+    """Relay one SDP offer/answer or ICE candidate to another peer in the same room.
+
+    Returns True (as the ack) when the message was forwarded.
+    """
+    code = data.get('code')
+    target = data.get('to')
+    kind = data.get('type')
+    if kind not in P2P_SIGNAL_TYPES or not isinstance(target, str) or not code:
+        return False
+    # Only members of the room's P2P group may signal, and only to a single peer of that group
+    if p2p_room(code) not in socket_rooms():
+        return False
+    payload = data.get('payload')
+    if len(json.dumps(payload)) > P2P_SIGNAL_MAX_BYTES:
+        return False
+
+    metrics.p2p_signals += 1
+    emit('p2p_signal', {'from': request.sid, 'code': code, 'type': kind, 'payload': payload},
+         to=p2p_peer_room(code, target))
+    return True
+
+# ────────────────────────────────────────────────
+#  🆕 PRE-COMPRESSED PAGE & STATIC FILE CACHE
+# ────────────────────────────────────────────────
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json",
+                      "application/xml", "image/svg+xml")
+
+class CachedBody:
+    """One response body with its identity, gzip and (if available) brotli encodings.
+
+    Each encoding gets its own strong ETag, derived from the uncompressed content.
+    """
+
+    __slots__ = ("mimetype", "version", "variants")
+
+    def __init__(self, body, mimetype, version):
+        self.mimetype = mimetype
+        self.version = version
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {"identity": (body, etag)}
+        if mimetype.startswith(COMPRESSIBLE_TYPES) and len(body) > 512:
+            # Compressed once, so the slowest/smallest settings are affordable
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(body, quality=11), etag)
+            self._add_variant("gzip", gzip.compress(body, compresslevel=9, mtime=0), etag)
+
+    def _add_variant(self, encoding, data, etag):
+        if len(data) < len(self.variants["identity"][0]):
+            self.variants[encoding] = (data, f"{etag}-{encoding}")
+
+    def pick(self, accept_encodings):
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding
+        return "identity"
+
+class ResponseCache:
+    """LRU of CachedBody objects, rebuilt when their source version changes.
+
+    Bounded because sitemap/robots entries are keyed by the request host.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, key, version, build):
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            body, mimetype = build()
+            entry = CachedBody(body, mimetype, version)
+            self._entries[key] = entry
+            self.builds += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "builds": self.builds,
+                "bytes": sum(len(data) for e in self._entries.values() for data, _ in e.variants.values())}
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES)
+
+# Source files state: (checked at, {path: (mtime_ns, size)}, generation)
+_sources = (float("-inf"), {}, 0)
+
+def _scan_sources():
+    """Stat every file in templates/ and static/. Blocking: call through io_pool."""
+    found = {}
+    for folder in (os.path.join(app.root_path, app.template_folder), app.static_folder):
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    found[entry.path] = (st.st_mtime_ns, st.st_size)
+    return found
+
+def source_versions():
+    """({path: (mtime_ns, size)}, generation) for templates and static files.
+
+    Re-checked at most every SOURCE_CHECK_SECS. The generation goes up whenever
+    anything changed, which invalidates every cached page.
+    """
+    global _sources
+    checked_at, versions, generation = _sources
+    now = time.monotonic()
+    if now - checked_at >= SOURCE_CHECK_SECS:
+        found = io_pool.run(_scan_sources)
+        if found != versions:
+            generation += 1
+            # Jinja does not re-read templates in production; make it
+            app.jinja_env.cache.clear()
+        _sources = (now, found, generation)
+        versions = found
+    return versions, generation
+
+def static_fingerprint(version):
+    return hashlib.sha1(repr(version).encode()).hexdigest()[:10]
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    """url_for('static', ...) gets ?v=<fingerprint>, so those URLs can be cached forever."""
+    if endpoint == "static" and "v" not in values:
+        path = safe_join(app.static_folder, values.get("filename", ""))
+        version = source_versions()[0].get(path)
+        if version is not None:
+            values["v"] = static_fingerprint(version)
+
+def cached_response(entry, max_age, immutable=False):
+    """Serve the best encoding the client accepts, answering If-None-Match with 304."""
+    encoding = entry.pick(request.accept_encodings)
+    body, etag = entry.variants[encoding]
+    resp = Response(body, mimetype=entry.mimetype)
+    if encoding != "identity":
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = max_age
+    if immutable:
+        resp.cache_control.immutable = True
+    return resp.make_conditional(request)
+
+def cached_page(key, render, mimetype="text/html", extra_version=None):
+    """Cache a rendered page until a template or static file changes."""
+    version = (source_versions()[1], extra_version)
+    entry = response_cache.get(key, version, lambda: (render().encode("utf-8"), mimetype))
+    return cached_response(entry, PAGE_MAX_AGE)
+
+def serve_static(filename):
+    """Replacement for Flask's static view: in-memory, pre-compressed, long-lived."""
+    path = safe_join(app.static_folder, filename)
+    version = source_versions()[0].get(path) if path else None
+    if version is None or version[1] > STATIC_CACHE_MAX_FILE:
+        # Missing, nested or large files: Flask's normal send_file path
+        return send_from_directory(app.static_folder, filename, max_age=STATIC_MAX_AGE)
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    entry = response_cache.get(("static", filename), version,
+                               lambda: (io_pool.run(Path(path).read_bytes), mimetype))
+    if request.args.get("v") == static_fingerprint(version):
+        return cached_response(entry, STATIC_IMMUTABLE_MAX_AGE, immutable=True)
+    return cached_response(entry, STATIC_MAX_AGE)
+
+app.view_functions["static"] = serve_static
+
 # ────────────────────────────────────────────────
 #  MAIN ROUTES
 # ────────────────────────────────────────────────
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return cached_page("index", lambda: render_template("index.html"))
 
 @app.route("/create", methods=["POST"])
 def create_room():
-    code = generate_code()
-    
-    with room_lock:
-        room_store[code] = {
-            "timestamp": datetime.now(),
-            "files": [],
-            "history": []
-        }
+    created = datetime.now()
+    while True:
+        code = room_codes.allocate()
+        if code is None:
+            return (render_template("index.html", error="All rooms are in use, please try again in a few minutes."),
+                    503, {"Retry-After": str(upload_retry_after())})
+        if rooms.create_room(code, created):
+            break
+        room_codes.collisions += 1  # Taken by a room this allocator didn't issue
+    schedule_expiry(created + timedelta(minutes=ROOM_DURATION_MINS))
     
     user = get_or_create_user()
     add_history(code, user, "created room")
@@ -165,12 +2891,10 @@ def create_room():
 def join_existing_room():
     code = request.form.get("code", "").strip()
     
-    with room_lock:
-        if code not in room_store:
-            return render_template("index.html", error="Invalid or expired code")
-    
+    # Logging the join doubles as the existence check (one trip to the store)
     user = get_or_create_user()
-    add_history(code, user, "joined room")
+    if not add_history(code, user, "joined room"):
+        return render_template("index.html", error="Invalid or expired code")
     
     response = make_response(redirect(url_for('room_page', code=code)))
     response.set_cookie('user_id', user, max_age=60*60*24)
@@ -179,13 +2903,10 @@ def join_existing_room():
 # Handle Direct Join Links (QR Code)
 @app.route("/j/<code>")
 def join_via_link(code):
-    with room_lock:
-        if code not in room_store:
-            return render_template("index.html", error="Room expired or invalid")
-    
-    # Create user and log history
+    # Create user and log history (fails if the room is gone)
     user = get_or_create_user()
-    add_history(code, user, "joined via QR/Link")
+    if not add_history(code, user, "joined via QR/Link"):
+        return render_template("index.html", error="Room expired or invalid")
     
     # Set cookie and redirect
     response = make_response(redirect(url_for('room_page', code=code)))
@@ -194,14 +2915,14 @@ def join_via_link(code):
 
 @app.route("/room/<code>")
 def room_page(code):
-    with room_lock:
-        if code not in room_store:
-            return render_template("index.html", error="Room not found or expired")
-        
-        room_data = room_store[code]
-        files = room_data["files"]
-        history = room_data["history"]
-        timestamp = room_data["timestamp"]
+    room_data = rooms.get_room(code)
+    if room_data is None:
+        return render_template("index.html", error="Room not found or expired")
+
+    files = room_data["files"]
+    # Only the newest HISTORY_PAGE_SIZE entries; older ones load from /api/room/<code>/history
+    history = room_data["history"]
+    timestamp = room_data["timestamp"]
 
     user = get_or_create_user()
     
@@ -215,143 +2936,224 @@ def room_page(code):
                          code=code,
                          files=files,
                          history=history,
+                         history_more=room_data["history_more"],
+                         version=room_data["version"],
                          current_user=user,
-                         remaining_seconds=max(0, remaining_seconds)))
+                         remaining_seconds=max(0, remaining_seconds),
+                         p2p_enabled=P2P_ENABLED,
+                         ice_servers=P2P_ICE_SERVERS,
+                         live_pipes=LIVE_PIPES_ENABLED))
     
     resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     resp.headers["Pragma"] = "no-cache"
     resp.headers["Expires"] = "0"
     return resp
 
+@app.route("/api/room/<code>/history")
+def room_history(code):
+    """Older history entries, newest first. Pass next_before back as ?before= for the next page."""
+    before = request.args.get("before", type=int)
+    limit = min(max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_CAPACITY)
+    page = rooms.get_history(code, before, limit)
+    if page is None:
+        return jsonify({"error": "Room not found or expired"}), 404
+
+    entries, next_before = page
+    return jsonify({
+        "entries": [entry.as_dict() for entry in entries],
+        "next_before": next_before
+    })
+
+@app.route("/api/room/<code>/state")
+def room_state(code):
+    """What changed in a room since ?since=<version>: new files and history entries.
+
+    Clients keep the returned version and pass it back next time, so a
+    reconnect or a finished upload costs a small delta instead of a page
+    reload. Without `since` (or with one the room never reached) the
+    response has "full": true and lists every file.
+    """
+    since = request.args.get("since", type=int)
+    changes = rooms.get_changes(code, since)
+    if changes is None:
+        return jsonify({"error": "Room not found or expired"}), 404
+
+    resp = jsonify(dict(changes, history=[entry.as_dict() for entry in changes["history"]]))
+    # Nothing new means the same body again, so polling clients get a 304. Hashing the body
+    # rather than naming the version keeps a recreated room's code from matching old tags.
+    resp.add_etag()
+    resp.cache_control.no_cache = True
+    resp.cache_control.private = True
+    return resp.make_conditional(request)
+
+def wants_json():
+    """True when the client prefers a JSON reply over an HTML redirect (fetch/XHR callers)."""
+    return request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+
 # ────────────────────────────────────────────────
 #  FILE UPLOAD/DOWNLOAD ROUTES
 # ────────────────────────────────────────────────
 
 @app.route("/upload/<code>", methods=["POST"])
 def upload_file(code):
-    with room_lock:
-        if code not in room_store:
-            return redirect(url_for('index'))
+    if not rooms.room_exists(code):
+        if wants_json():
+            return jsonify({"error": "Room not found or expired"}), 404
+        return redirect(url_for('index'))
+
+    # 🆕 QUOTA: Decide from Content-Length before touching the body
+    reserved = request.content_length or app.config["MAX_CONTENT_LENGTH"]
+    rejection = storage.admit(code, reserved)
+    if rejection:
+        status, _, message = rejection
+        headers = rejection_headers(status)
+        if wants_json():
+            return jsonify({"error": message}), status, headers
+        return message, status, headers
 
     user = get_or_create_user()
-    files = request.files.getlist("file")
-    uploaded_files = []
-    
-    # Process files
     processed_files_data = []
-    for file in files:
-        if file and file.filename:
-            orig_name = file.filename
-            stored_name = f"{code}_{int(time.time())}_{secure_filename(orig_name)}"
-            path = Path(UPLOAD_FOLDER) / stored_name
-            file.save(path)
-            
-            processed_files_data.append({
-                "original_name": orig_name,
-                "stored_name": stored_name,
-                "size": get_human_size(path.stat().st_size),
-                "type": orig_name.split('.')[-1].upper() if '.' in orig_name else "FILE",
-                "sender": user
-            })
-
-    # Update store safely
-    with room_lock:
-        if code in room_store:
-            current_count = len(room_store[code]["files"])
-            for i, f_data in enumerate(processed_files_data):
-                f_data["index"] = current_count + i
-                room_store[code]["files"].append(f_data)
-                uploaded_files.append(f_data)
-    
-    if uploaded_files:
-        add_history(code, user, f"sent {len(uploaded_files)} file(s)")
-        socketio.emit('new_files', {
-            'files': uploaded_files,
-            'sender': user
-        }, to=code)
-            
+    # Blob references taken by this request that no room holds yet
+    unowned = []
+    try:
+        files = request.files.getlist("file")
+
+        # Process files
+        for file in files:
+            if file and file.filename:
+                orig_name = file.filename
+                stored_name, size = file.stream.commit()
+                unowned.append(stored_name)
+                processed_files_data.append(make_file_record(orig_name, stored_name, size, user))
+
+        published = publish_files(code, user, processed_files_data)
+        if published:
+            unowned.clear()
+    finally:
+        storage.release(code, reserved)
+        # Files of a request that failed half-way were never committed
+        for part in request.upload_parts:
+            part.discard()
+        # Failed half-way, or the room vanished while we were writing: give the references back
+        release_blobs(unowned)
+    # 🆕 JSON: Scripted uploads get the new entries instead of a full room page reload
+    if wants_json():
+        if processed_files_data and not published:
+            return jsonify({"error": "Room not found or expired"}), 404
+        return jsonify({"files": published}), 201
     return redirect(url_for('room_page', code=code))
 
+def is_download_start(resp):
+    """True for the response that begins a logical download.
+
+    Resumed or segmented transfers (206 not starting at byte 0), cache
+    revalidations (304) and HEAD requests are parts of a download that was
+    already counted.
+    """
+    if request.method != "GET":
+        return False
+    if resp.status_code == 200:
+        return True
+    return resp.status_code == 206 and resp.content_range is not None and resp.content_range.start == 0
+
 @app.route("/download/<code>/<int:index>")
 def download_file(code, index):
-    file_info = None
-    
-    with room_lock:
-        if code in room_store and index < len(room_store[code]["files"]):
-            file_info = room_store[code]["files"][index]
-    
-    if file_info:
+    file_info = rooms.get_file(code, index)
+    if not file_info:
+        return "File not found", 404
+
+    # 🆕 HOT FILES: Files many people download are sent from a shared in-memory map.
+    # Range requests (resumes, segmented downloaders) always use sendfile.
+    mm = None
+    if request.range is None:
+        mm = hot_files.get(file_info["stored_name"], file_info.get("size_bytes", 0))
+    if mm is not None:
+        resp = Response(iter_mapped(mm), direct_passthrough=True,
+                        mimetype=mimetypes.guess_type(file_info["original_name"])[0] or "application/octet-stream")
+        resp.headers["Content-Disposition"] = attachment_header(file_info["original_name"])
+        resp.content_length = len(mm)
+        resp.set_etag(file_info["stored_name"])
+        resp.cache_control.max_age = ROOM_DURATION_MINS * 60
+        resp = resp.make_conditional(request, accept_ranges=True, complete_length=len(mm))
+    else:
+        # 🟢 RESUMABLE: send_file answers Range / If-Range with 206 and If-None-Match with 304.
+        # Blobs are content-addressed, so their SHA-256 is a strong ETag. The body goes out
+        # through wsgi.file_wrapper (sendfile under gunicorn) instead of being copied in Python.
+        resp = send_from_directory(UPLOAD_FOLDER,
+                                   file_info["stored_name"],
+                                   as_attachment=True,
+                                   download_name=file_info["original_name"],
+                                   etag=file_info["stored_name"],
+                                   max_age=ROOM_DURATION_MINS * 60)
+        resp.cache_control.public = False
+    resp.cache_control.private = True
+    if request.method == "GET" and resp.status_code in (200, 206):
+        metrics.bytes_downloaded += resp.content_length or 0
+
+    if is_download_start(resp):
         user = get_or_create_user()
         add_history(code, user, f"downloaded: {file_info['original_name']}")
-        
-        socketio.emit('file_downloaded', {
-            'filename': file_info['original_name'],
-            'user': user
-        }, to=code)
-        
-        return send_from_directory(UPLOAD_FOLDER, 
-                                   file_info["stored_name"], 
-                                   as_attachment=True, 
-                                   download_name=file_info["original_name"])
-    return "File not found", 404
+
+        event_batcher.file_downloaded(code, file_info['original_name'], user)
+    return resp
 
 @app.route("/download_all/<code>")
 def download_all(code):
-    files_to_zip = []
-    
-    with room_lock:
-        if code not in room_store:
-            return "Room not found", 404
-        # Create a shallow copy to use outside the lock
-        files_to_zip = list(room_store[code]["files"])
+    # Snapshot copy, safe to use while other requests modify the room
+    files_to_zip = rooms.get_files(code)
+    if files_to_zip is None:
+        return "Room not found", 404
     
     if not files_to_zip:
         return "No files to download", 404
     
+    entries = []
+    for file_info in files_to_zip:
+        file_path = Path(UPLOAD_FOLDER) / file_info["stored_name"]
+        if io_pool.run(file_path.exists):
+            entries.append((file_path, file_info["original_name"]))
+
+    if not entries:
+        return "No files to download", 404
+
     user = get_or_create_user()
-    memory_file = io.BytesIO()
-    
-    try:
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for file_info in files_to_zip:
-                file_path = Path(UPLOAD_FOLDER) / file_info["stored_name"]
-                if file_path.exists():
-                    zf.write(file_path, file_info["original_name"])
-    except Exception as e:
-        return f"Error creating zip: {str(e)}", 500
-    
-    memory_file.seek(0)
     add_history(code, user, "downloaded all files")
-    
-    return (memory_file.getvalue(), 200, {
+
+    headers = {
         'Content-Type': 'application/zip',
         'Content-Disposition': f'attachment; filename=files_{code}.zip'
-    })
+    }
+    # 🆕 ARCHIVE CACHE: Everyone after the first requester gets the finished ZIP from memory
+    version = archive_cache.version(entries)
+    body = archive_cache.get(code, version)
+    if body is not None:
+        resp = Response(body, headers=headers)
+        resp.set_etag(version)
+        resp.cache_control.private = True
+        resp = resp.make_conditional(request, accept_ranges=True, complete_length=len(body))
+        if request.method == "GET":
+            metrics.bytes_downloaded += resp.content_length or 0
+        return resp
+
+    # 🟢 STREAMING: First bytes go out immediately. Small enough to cache: built once and
+    # shared with everyone asking meanwhile; bigger archives (or all, with the cache off)
+    # are never held in memory
+    if archive_cache.max_bytes > 0 and sum(f.get("size_bytes", 0) for f in files_to_zip) <= archive_cache.max_archive:
+        return Response(archive_cache.build(code, version, entries).follow(), headers=headers)
+    return Response(metered_zip(entries), headers=headers)
 
 # 🟢 NEW ROUTE: Immediate Room Destruction (Exit & Delete)
 @app.route("/destroy/<code>", methods=["POST"])
 def destroy_room(code):
-    files_to_delete = []
-    
-    # 1. Remove from memory safely
-    with room_lock:
-        if code in room_store:
-            # Get list of files to delete from disk
-            for file_info in room_store[code]["files"]:
-                files_to_delete.append(file_info["stored_name"])
-            
-            # Delete room data from memory
-            del room_store[code]
-            print(f"💥 Room {code} destroyed by user.")
-    
-    # 2. Delete files from disk
-    for filename in files_to_delete:
-        try:
-            file_path = Path(UPLOAD_FOLDER) / filename
-            if file_path.exists():
-                file_path.unlink() # Deletes the file
-        except Exception as e:
-            print(f"Error deleting file {filename}: {e}")
+    # 1. Remove room data (and its unfinished uploads) from the store
+    removed = rooms.delete_room(code)
+    if removed is not None:
+        print(f"💥 Room {code} destroyed by user.")
+        forget_room(code)
+
+        # 2. Delete files from disk (blobs only once no other room uses them)
+        release_blobs(f["stored_name"] for f in removed["files"])
+        delete_upload_files(removed["parts"])
 
     # 3. Notify everyone in the room to leave
     socketio.emit('room_destroyed', {}, to=code)
@@ -359,6 +3161,266 @@ def destroy_room(code):
     # 4. Redirect the user who clicked the button to home
     return redirect(url_for('index'))
 
+# ────────────────────────────────────────────────
+#  🆕 NEW: CHUNKED (RESUMABLE) UPLOAD ROUTES
+# ────────────────────────────────────────────────
+#  1. POST /upload/<code>/sessions              {"filename", "size", "chunk_size"?}
+#  2. PUT  /upload/<code>/sessions/<id>?offset=N  raw chunk body (parallel OK)
+#  3. GET  /upload/<code>/sessions/<id>         -> received byte ranges
+#  4. POST /upload/<code>/sessions/<id>/finalize -> file appears in the room
+
+def _get_upload_session(code, upload_id):
+    session = rooms.get_upload(upload_id)
+    if session and session["code"] == code:
+        return session
+    return None
+
+def _session_status(upload_id, session):
+    return {
+        "upload_id": upload_id,
+        "filename": session["original_name"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "received": [list(r) for r in session["received"]],
+        "complete": session["received"] == [[0, session["size"]]] or session["size"] == 0
+    }
+
+def _presize_file(path, size):
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+@app.route("/upload/<code>/sessions", methods=["POST"])
+def create_upload_session(code):
+    if not rooms.room_exists(code):
+        return jsonify({"error": "Room not found or expired"}), 404
+
+    data = request.get_json(silent=True) or {}
+    orig_name = str(data.get("filename", "")).strip()
+    try:
+        size = int(data.get("size", -1))
+        chunk_size = int(data.get("chunk_size", UPLOAD_CHUNK_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({"error": "size and chunk_size must be integers"}), 400
+
+    if not orig_name or size < 0:
+        return jsonify({"error": "filename and size are required"}), 400
+    if size > UPLOAD_SESSION_MAX_SIZE:
+        return jsonify({"error": "File too large"}), 413
+    chunk_size = min(max(chunk_size, UPLOAD_CHUNK_MIN), UPLOAD_CHUNK_MAX)
+
+    # 🆕 QUOTA: The open session counts against the budgets from here on (via the store)
+    rejection = storage.admit(code, size)
+    if rejection:
+        status, _, message = rejection
+        headers = rejection_headers(status)
+        return jsonify({"error": message}), status, headers
+
+    try:
+        upload_id = secrets.token_urlsafe(16)
+        part_name = new_part_name()
+        # Pre-size the file so chunks can be written at their offsets in any order
+        io_pool.run(_presize_file, Path(UPLOAD_FOLDER) / part_name, size)
+
+        session = {
+            "code": code,
+            "original_name": orig_name,
+            "part_name": part_name,
+            "size": size,
+            "chunk_size": chunk_size,
+            "received": [],
+            "user": get_or_create_user()
+        }
+        rooms.create_upload(upload_id, session)
+    finally:
+        storage.release(code, size)
+    return jsonify(_session_status(upload_id, session)), 201
+
+@app.route("/upload/<code>/sessions/<upload_id>", methods=["PUT", "POST"])
+def upload_chunk(code, upload_id):
+    session = _get_upload_session(code, upload_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+
+    offset = request.args.get("offset", type=int)
+    length = request.content_length
+    if length is None:
+        return jsonify({"error": "Content-Length required"}), 411
+    size, chunk_size = session["size"], session["chunk_size"]
+    if offset is None or offset < 0 or offset % chunk_size:
+        return jsonify({"error": "offset must be a multiple of chunk_size"}), 400
+    if length != min(chunk_size, size - offset):
+        return jsonify({"error": "Chunk length does not match chunk_size"}), 416
+
+    # Stream the body straight into place instead of letting Werkzeug spool it
+    written = 0
+    fd = io_pool.run(os.open, Path(UPLOAD_FOLDER) / session["part_name"], os.O_WRONLY)
+    try:
+        while written < length:
+            buf = request.stream.read(min(IO_CHUNK_SIZE, length - written))
+            if not buf:
+                break
+            io_pool.run(os.pwrite, fd, buf, offset + written)
+            written += len(buf)
+            metrics.bytes_uploaded += len(buf)
+    finally:
+        io_pool.run(os.close, fd)
+
+    if written:
+        session = rooms.add_upload_range(upload_id, offset, offset + written)
+        if session is None:
+            return jsonify({"error": "Upload session not found"}), 404
+    status = _session_status(upload_id, session)
+
+    if written < length:
+        return jsonify(dict(status, error="Chunk incomplete, resend it")), 400
+    return jsonify(status)
+
+@app.route("/upload/<code>/sessions/<upload_id>", methods=["GET"])
+def upload_session_status(code, upload_id):
+    session = _get_upload_session(code, upload_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    return jsonify(_session_status(upload_id, session))
+
+@app.route("/upload/<code>/sessions/<upload_id>/finalize", methods=["POST"])
+def finalize_upload_session(code, upload_id):
+    session = _get_upload_session(code, upload_id)
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    status = _session_status(upload_id, session)
+    if not status["complete"]:
+        return jsonify(dict(status, error="Upload incomplete")), 409
+    if rooms.pop_upload(upload_id) is None:
+        return jsonify({"error": "Upload session not found"}), 404  # Finalized concurrently
+
+    # Chunks may arrive in any order, so the content hash is taken once at the end
+    digest = commit_blob(session["part_name"], io_pool.run(hash_file, Path(UPLOAD_FOLDER) / session["part_name"]))
+    record = make_file_record(session["original_name"], digest, session["size"], session["user"])
+    try:
+        published = publish_files(code, session["user"], [record])
+    except BaseException:
+        release_blobs([digest])
+        raise
+    if not published:
+        release_blobs([digest])
+        return jsonify({"error": "Room not found or expired"}), 404
+    return jsonify(published[0])
+
+# ────────────────────────────────────────────────
+#  🆕 NEW: LIVE PIPE ROUTES
+# ────────────────────────────────────────────────
+#  PUT /upload/<code>/pipe?filename=NAME   raw body; 'pipe_started' goes out to the room at once
+#  GET /pipe/<code>/<pipe_id>              streams the upload while it is still arriving
+
+@app.route("/upload/<code>/pipe", methods=["PUT", "POST"])
+def upload_pipe(code):
+    if not LIVE_PIPES_ENABLED:
+        # A receiver could land on a worker that doesn't know the pipe
+        return jsonify({"error": "Live uploads need a single worker, use chunked uploads"}), 501
+    if not rooms.room_exists(code):
+        return jsonify({"error": "Room not found or expired"}), 404
+    orig_name = request.args.get("filename", "").strip()
+    if not orig_name:
+        return jsonify({"error": "filename is required"}), 400
+    size = request.content_length
+    if size is None:
+        return jsonify({"error": "Content-Length required"}), 411
+    if size > UPLOAD_SESSION_MAX_SIZE:
+        return jsonify({"error": "File too large"}), 413
+
+    rejection = storage.admit(code, size)
+    if rejection:
+        status, _, message = rejection
+        return jsonify({"error": message}), status, rejection_headers(status)
+
+    user = get_or_create_user()
+    pipe = pipes.open(code, orig_name, size, user)
+    try:
+        # Not batched: receivers should start pulling immediately
+        socketio.emit('pipe_started', {
+            'pipe_id': pipe.id,
+            'filename': orig_name,
+            'size': get_human_size(size),
+            'sender': user,
+            'url': url_for('download_pipe', code=code, pipe_id=pipe.id)
+        }, to=code)
+
+        hasher = hashlib.sha256()
+        out = io_pool.run(open, Path(UPLOAD_FOLDER) / pipe.part_name, "wb")
+        try:
+            while pipe.received < size:
+                chunk = request.stream.read(min(PIPE_CHUNK_SIZE, size - pipe.received))
+                if not chunk:
+                    break
+                pipe.push(chunk)
+                # Receivers keep streaming from memory while this chunk goes to disk
+                io_pool.run(_hash_write_flush, hasher, out, chunk)
+                pipe.written(len(chunk))
+                metrics.bytes_uploaded += len(chunk)
+        finally:
+            io_pool.run(out.close)
+
+        if pipe.received < size:
+            pipe.finish(failed=True)
+            delete_upload_files([pipe.part_name])
+            socketio.emit('pipe_failed', {'pipe_id': pipe.id}, to=code)
+            return jsonify({"error": "Upload incomplete"}), 400
+        pipe.finish()
+
+        digest = commit_blob(pipe.part_name, hasher.hexdigest())
+        try:
+            published = publish_files(code, user, [make_file_record(orig_name, digest, size, user)])
+        except BaseException:
+            release_blobs([digest])
+            raise
+        if not published:
+            release_blobs([digest])
+            return jsonify({"error": "Room not found or expired"}), 404
+        pipe.file_index = published[0]["index"]
+        socketio.emit('pipe_finished', {'pipe_id': pipe.id, 'index': pipe.file_index}, to=code)
+        return jsonify(dict(published[0], pipe_id=pipe.id)), 201
+    except BaseException:
+        if not pipe.done:
+            pipe.finish(failed=True)
+            delete_upload_files([pipe.part_name])
+            socketio.emit('pipe_failed', {'pipe_id': pipe.id}, to=code)
+        raise
+    finally:
+        storage.release(code, size)
+        pipes.retire(pipe)
+
+@app.route("/pipe/<code>/<pipe_id>")
+def download_pipe(code, pipe_id):
+    pipe = pipes.get(pipe_id)
+    if pipe is None or pipe.code != code or pipe.failed:
+        return "File not found", 404
+    if pipe.file_index is not None:
+        # Already stored: the normal download supports resume and caching
+        return redirect(url_for('download_file', code=code, index=pipe.file_index))
+
+    reader = pipe.attach()
+    user = get_or_create_user()
+
+    def generate():
+        sent = 0
+        try:
+            for chunk in pipe.stream(reader):
+                sent += len(chunk)
+                metrics.bytes_downloaded += len(chunk)
+                yield chunk
+        finally:
+            pipe.detach(reader)
+        if sent == pipe.size:
+            add_history(code, user, f"downloaded: {pipe.filename}")
+            event_batcher.file_downloaded(code, pipe.filename, user)
+
+    return Response(generate(), headers={
+        'Content-Type': 'application/octet-stream',
+        'Content-Length': str(pipe.size),
+        'Content-Disposition': attachment_header(pipe.filename),
+        'Cache-Control': 'no-store'
+    })
+
 # ────────────────────────────────────────────────
 #  🆕 NEW: ABOUT & CONTACT ROUTES
 # ────────────────────────────────────────────────
@@ -366,12 +3428,15 @@ def destroy_room(code):
 @app.route("/about")
 def about():
     """About page - Information about the platform and creator"""
-    return render_template("about.html")
+    return cached_page("about", lambda: render_template("about.html"))
 
 @app.route("/contact")
 def contact():
     """Contact page with form"""
-    return render_template("contactus.html")
+    # A pending flash message (after submitting the form) makes the page personal
+    if "_flashes" in session:
+        return render_template("contactus.html")
+    return cached_page("contact", lambda: render_template("contactus.html"))
 
 @app.route("/contact/submit", methods=["POST"])
 def contact_submit():
@@ -451,29 +3516,29 @@ def sitemap():
     # Get current date for lastmod
     current_date = datetime.now().strftime("%Y-%m-%d")
     
-    # Define all your static pages
-    pages = [
-        {"loc": url_for('index', _external=True), "priority": "1.0"},
-        {"loc": url_for('about', _external=True), "priority": "0.8"},
-        {"loc": url_for('contact', _external=True), "priority": "0.8"},
-    ]
-    
-    sitemap_xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    sitemap_xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    
-    for page in pages:
-        sitemap_xml += '  <url>\n'
-        sitemap_xml += f'    <loc>{page["loc"]}</loc>\n'
-        sitemap_xml += f'    <lastmod>{current_date}</lastmod>\n'
-        sitemap_xml += '    <changefreq>daily</changefreq>\n'
-        sitemap_xml += f'    <priority>{page["priority"]}</priority>\n'
-        sitemap_xml += '  </url>\n'
-    
-    sitemap_xml += '</urlset>'
-    
-    response = make_response(sitemap_xml)
-    response.headers["Content-Type"] = "application/xml"
-    return response
+    def render():
+        # Define all your static pages
+        pages = [
+            {"loc": url_for('index', _external=True), "priority": "1.0"},
+            {"loc": url_for('about', _external=True), "priority": "0.8"},
+            {"loc": url_for('contact', _external=True), "priority": "0.8"},
+        ]
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+        for page in pages:
+            parts.append('  <url>\n'
+                         f'    <loc>{page["loc"]}</loc>\n'
+                         f'    <lastmod>{current_date}</lastmod>\n'
+                         '    <changefreq>daily</changefreq>\n'
+                         f'    <priority>{page["priority"]}</priority>\n'
+                         '  </url>\n')
+        parts.append('</urlset>')
+        return "".join(parts)
+
+    # URLs are absolute, so each host gets its own entry; lastmod changes daily
+    return cached_page(("sitemap", request.host_url), render,
+                       mimetype="application/xml", extra_version=current_date)
 
 # ────────────────────────────────────────────────
 #  🆕 NEW: ROBOTS.TXT ROUTE (For SEO)
@@ -482,18 +3547,368 @@ def sitemap():
 @app.route("/robots.txt")
 def robots():
     """Generate robots.txt for search engines"""
-    robots_txt = """User-agent: *
+    def render():
+        return """User-agent: *
 Allow: /
 Disallow: /room/
 Disallow: /destroy/
 Disallow: /upload/
+Disallow: /pipe/
+Disallow: /stats
+Disallow: /metrics
+Disallow: /admin/
+Disallow: /api/
 
 Sitemap: """ + url_for('sitemap', _external=True)
-    
-    response = make_response(robots_txt)
-    response.headers["Content-Type"] = "text/plain"
+
+    return cached_page(("robots", request.host_url), render, mimetype="text/plain")
+
+# ────────────────────────────────────────────────
+#  🆕 NEW: SERVER STATS
+# ────────────────────────────────────────────────
+
+@app.route("/stats")
+def server_stats():
+    """Live counters for watching the server under load"""
+    return jsonify({
+        "rooms": rooms.room_count(),
+        "locks": rooms.lock_stats(),
+        "io": io_pool.stats(),
+        "events": event_batcher.stats(),
+        "response_cache": response_cache.stats(),
+        "storage": storage.stats(),
+        "pipes": pipes.stats(),
+        "room_codes": room_codes.stats(),
+        "hot_files": hot_files.stats(),
+        "archive_cache": archive_cache.stats(),
+        "bandwidth": shaper.stats()
+    })
+
+# ────────────────────────────────────────────────
+#  🆕 NEW: PROMETHEUS METRICS
+# ────────────────────────────────────────────────
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # Label by URL rule, not path, so room codes don't explode the series count
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe_request(route, request.method, response.status_code,
+                                time.perf_counter() - started)
+    return response
+
+def _scan_upload_folder():
+    """(bytes, files) stored in UPLOAD_FOLDER. Blocking: call through io_pool."""
+    total = count = 0
+    with os.scandir(UPLOAD_FOLDER) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+                count += 1
+    return total, count
+
+def upload_folder_usage():
+    """Cached _scan_upload_folder(), refreshed at most every DISK_USAGE_CACHE_SECS."""
+    measured_at, usage = metrics.disk_usage
+    if time.monotonic() - measured_at >= DISK_USAGE_CACHE_SECS:
+        usage = io_pool.run(_scan_upload_folder)
+        metrics.disk_usage = (time.monotonic(), usage)
+    return usage
+
+def render_metrics():
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if isinstance(samples, (int, float)):
+            lines.append(f"{name} {samples}")
+        else:
+            lines.extend(samples)
+
+    def histograms(name, help_text, labelled):
+        samples = []
+        for labels, hist in labelled:
+            samples.extend(hist.expose(name, labels))
+        family(name, "histogram", help_text, samples)
+
+    histograms("http_request_duration_seconds", "Time to produce the response (headers) per route.",
+               ((f'route="{route}",method="{method}"', hist)
+                for (route, method), hist in sorted(metrics.request_latency.items())))
+    family("http_responses_total", "counter", "Responses per route and status code.",
+           [f'http_responses_total{{route="{route}",method="{method}",status="{status}"}} {n}'
+            for (route, method, status), n in sorted(metrics.responses.items())])
+    family("upload_bytes_total", "counter", "File bytes received (form and chunked uploads).",
+           metrics.bytes_uploaded)
+    family("download_bytes_total", "counter", "File bytes sent (single files and ZIP archives).",
+           metrics.bytes_downloaded)
+
+    family("rooms_active", "gauge", "Rooms currently open.", rooms.room_count())
+    family("room_code_occupancy", "gauge", f"Share of the {ROOM_CODE_DIGITS}-digit room code space in use.",
+           room_codes.occupancy())
+    family("room_code_collisions_total", "counter", "Allocated codes already taken by another room.",
+           room_codes.collisions)
+    family("files_active", "gauge", "Files across all open rooms.", rooms.file_count())
+    family("socketio_connections", "gauge", "Connected Socket.IO clients on this worker.",
+           metrics.socket_connections)
+    family("p2p_signals_total", "counter", "WebRTC signaling messages relayed between peers.",
+           metrics.p2p_signals)
+    family("pipe_relayed_bytes_total", "counter", "Bytes streamed to live pipe receivers, by source.",
+           [f'pipe_relayed_bytes_total{{source="{source}"}} {n}' for source, n in metrics.pipe_bytes.items()])
+    family("rooms_expired_total", "counter", "Rooms removed by the expiry scheduler.", metrics.rooms_expired)
+
+    # In-memory store only; the SQLite store relies on database locking
+    lock_stats = getattr(rooms, "registry_lock_stats", None), getattr(rooms, "room_lock_stats", None)
+    labelled = [(f'lock="{name}"', stats) for name, stats in zip(("registry", "room"), lock_stats) if stats]
+    histograms("room_lock_wait_seconds", "Time spent waiting for a contended room store lock.",
+               ((labels, stats.wait) for labels, stats in labelled))
+    histograms("room_lock_hold_seconds", "Time a room store lock was held.",
+               ((labels, stats.hold) for labels, stats in labelled))
+    family("room_lock_acquisitions_total", "counter", "Room store lock acquisitions.",
+           [f"room_lock_acquisitions_total{{{labels}}} {stats.acquired}" for labels, stats in labelled])
+    family("room_lock_contended_total", "counter", "Acquisitions that had to wait.",
+           [f"room_lock_contended_total{{{labels}}} {stats.contended}" for labels, stats in labelled])
+
+    histograms("cleanup_sweep_duration_seconds", "Duration of one expired-room sweep.",
+               [("", metrics.cleanup_sweeps)])
+    histograms("zip_build_duration_seconds", "Time to stream a complete download_all archive.",
+               [("", metrics.zip_builds)])
+
+    family("bandwidth_throttled_seconds_total", "counter", "Time streams were held back by bandwidth limits.",
+           [f'bandwidth_throttled_seconds_total{{direction="{d}"}} {n}' for d, n in shaper.throttled_seconds.items()])
+
+    family("slow_requests_total", "counter", f"Requests slower than SLOW_REQUEST_SECS ({SLOW_REQUEST_SECS:g}s), per route.",
+           [f'slow_requests_total{{route="{route}"}} {n}' for route, n in sorted(slow_request_counts.items())])
+
+    caches = (("file", hot_files), ("archive", archive_cache))
+    family("download_cache_hits_total", "counter", "Downloads served from memory, by cache.",
+           [f'download_cache_hits_total{{cache="{name}"}} {cache.hits}' for name, cache in caches])
+    family("download_cache_misses_total", "counter", "Downloads not found in memory, by cache.",
+           [f'download_cache_misses_total{{cache="{name}"}} {cache.misses}' for name, cache in caches])
+    family("archive_builds_joined_total", "counter", "Download All requests that followed an archive already being built.",
+           archive_cache.joined)
+    family("download_cache_bytes", "gauge", "Bytes held by each download cache.",
+           [f'download_cache_bytes{{cache="{name}"}} {cache.bytes}' for name, cache in caches])
+
+    used_bytes, stored_files = upload_folder_usage()
+    family("upload_folder_bytes", "gauge", f"Bytes stored in UPLOAD_FOLDER (refreshed every {DISK_USAGE_CACHE_SECS}s).", used_bytes)
+    family("upload_folder_files", "gauge", f"Files stored in UPLOAD_FOLDER (refreshed every {DISK_USAGE_CACHE_SECS}s).", stored_files)
+    family("upload_folder_free_bytes", "gauge", "Free space on the UPLOAD_FOLDER filesystem.",
+           shutil.disk_usage(UPLOAD_FOLDER).free)
+    family("storage_stored_bytes", "gauge", "Bytes counted against STORAGE_QUOTA_BYTES.", rooms.stored_bytes())
+    family("uploads_rejected_total", "counter", "Uploads refused by admission control.",
+           [f'uploads_rejected_total{{reason="{reason}"}} {n}' for reason, n in storage.rejected.items()])
+    family("rooms_evicted_total", "counter", "Rooms deleted early above the high disk watermark.",
+           storage.evicted)
+
+    io = io_pool.stats()
+    family("io_pool_queued", "gauge", "Disk operations waiting for an I/O thread.", io["queued"])
+    family("io_pool_active", "gauge", "Disk operations running on I/O threads.", io["active"])
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ────────────────────────────────────────────────
+#  🆕 NEW: PROFILER & SLOW REQUEST TRACES
+# ────────────────────────────────────────────────
+
+# The sampler must be a real OS thread: a green thread would only ever see its own stack
+_native_threading = eventlet.patcher.original("threading")
+_native_sleep = eventlet.patcher.original("time").sleep
+_hub_thread_id = eventlet.patcher.original("_thread").get_ident()
+
+def collapse_stack(frame, limit=128):
+    """"outermost;...;innermost" frame names, the folded format flamegraph.pl and speedscope read."""
+    names = []
+    while frame is not None and len(names) < limit:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class StackSampler:
+    """Low-overhead statistical profiler for a limited time window.
+
+    A native thread wakes up `hz` times a second and records the current
+    Python stack of every thread. The hub thread's stack is whatever green
+    thread is running at that moment (or the hub waiting for I/O when the
+    worker is idle); the I/O pool threads show where blocking work such as
+    ZIP deflate spends its time.
+    """
+
+    def __init__(self):
+        self._lock = _native_threading.Lock()
+        self._stop = _native_threading.Event()
+        self._thread = None
+        self.counts = {}
+        self.samples = 0
+        self.hz = 0
+        self.started_at = None
+        self.ends_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, hz):
+        """Begin a new window, discarding the previous profile. False if one is running."""
+        if self.running:
+            return False
+        self.counts, self.samples, self.hz = {}, 0, hz
+        self.started_at = time.time()
+        self.ends_at = self.started_at + seconds
+        self._stop.clear()
+        self._thread = _native_threading.Thread(target=self._run, args=(seconds, hz),
+                                                name="stack-sampler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def _label(thread_id, stack):
+        if thread_id == _hub_thread_id:
+            return f"hub;{stack}"
+        # I/O pool threads waiting for work would otherwise dominate the profile
+        frames = stack.split(";")
+        for i, name in enumerate(frames[:-1]):
+            if name.startswith("tworker (tpool.py") and frames[i + 1].startswith("get (queue.py"):
+                return "io;(idle)"
+        return f"io;{stack}"
+
+    def _run(self, seconds, hz):
+        own_id = _native_threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            keys = [self._label(tid, collapse_stack(frame))
+                    for tid, frame in sys._current_frames().items() if tid != own_id]
+            with self._lock:
+                for key in keys:
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                self.samples += 1
+            _native_sleep(1 / hz)
+        self.ends_at = min(self.ends_at, time.time())
+
+    def collapsed(self):
+        """One "stack count" line per distinct stack, most frequent first."""
+        with self._lock:
+            counts = sorted(self.counts.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {n}\n" for stack, n in counts)
+
+    def stats(self):
+        return {"running": self.running, "samples": self.samples, "hz": self.hz,
+                "started_at": self.started_at, "ends_at": self.ends_at}
+
+profiler = StackSampler()
+# Newest last; each entry is a dict ready for jsonify
+slow_traces = deque(maxlen=SLOW_TRACE_CAPACITY)
+slow_request_counts = {}  # route -> count
+
+def watch_slow_request(request_greenlet, samples):
+    """Runs once a request has passed SLOW_REQUEST_SECS: records where it is waiting.
+
+    While this green thread runs the request's green thread is suspended, so
+    its frame shows what it is blocked on (I/O pool, a lock, throttling...).
+    """
+    while True:
+        frame = request_greenlet.gr_frame
+        if frame is None:
+            return
+        stack = collapse_stack(frame)
+        samples[stack] = samples.get(stack, 0) + 1
+        eventlet.sleep(SLOW_TRACE_INTERVAL_SECS)
+
+@app.before_request
+def start_slow_request_watch():
+    if SLOW_REQUEST_SECS > 0:
+        g.trace_started = time.perf_counter()
+        g.trace_samples = {}
+        g.trace_watch = eventlet.spawn_after(SLOW_REQUEST_SECS, watch_slow_request,
+                                             eventlet.getcurrent(), g.trace_samples)
+
+@app.after_request
+def record_slow_request(response):
+    started = g.get("trace_started")
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    if duration >= SLOW_REQUEST_SECS:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        slow_request_counts[route] = slow_request_counts.get(route, 0) + 1
+        slow_traces.append({
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "route": route,
+            "method": request.method,
+            "path": request.path,
+            "room": (request.view_args or {}).get("code"),
+            "user": request.cookies.get("user_id"),
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 1),
+            "stacks": sorted(g.trace_samples.items(), key=lambda item: -item[1]),
+        })
+        print(f"🐢 Slow request: {request.method} {request.path} took {duration * 1000:.0f} ms")
     return response
 
+@app.teardown_request
+def stop_slow_request_watch(exc=None):
+    watch = g.pop("trace_watch", None)
+    if watch is not None:
+        watch.kill()
+
+def admin_required(view):
+    """Only requests carrying ADMIN_TOKEN get through; without a token configured the routes don't exist."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Not found"}), 404
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not secrets.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "Unauthorized"}), 401, {"WWW-Authenticate": "Bearer"}
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/admin/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    """Start sampling for ?seconds= (default 30) at ?hz= (default 100)."""
+    seconds = min(max(request.args.get("seconds", PROFILE_DEFAULT_SECS, type=float), 0.1), PROFILE_MAX_SECS)
+    hz = min(max(request.args.get("hz", PROFILE_DEFAULT_HZ, type=int), 1), PROFILE_MAX_HZ)
+    if not profiler.start(seconds, hz):
+        return jsonify(dict(profiler.stats(), error="A profile is already running")), 409
+    print(f"🔬 Profiler: sampling for {seconds:g}s at {hz} Hz")
+    return jsonify(profiler.stats()), 202
+
+@app.route("/admin/profile", methods=["DELETE"])
+@admin_required
+def stop_profile():
+    profiler.stop()
+    return jsonify(profiler.stats())
+
+@app.route("/admin/profile", methods=["GET"])
+@admin_required
+def get_profile():
+    """Collapsed stacks of the current or last window (feed to flamegraph.pl or speedscope)."""
+    return Response(profiler.collapsed(), mimetype="text/plain", headers={
+        "X-Profile-Samples": str(profiler.samples),
+        "X-Profile-Running": "1" if profiler.running else "0",
+        "Cache-Control": "no-store"
+    })
+
+@app.route("/admin/slow-requests")
+@admin_required
+def get_slow_requests():
+    """Recorded slow requests, newest first."""
+    return jsonify({"threshold_ms": SLOW_REQUEST_SECS * 1000, "requests": list(reversed(slow_traces))})
+
 # ────────────────────────────────────────────────
 #  ERROR HANDLERS
 # ────────────────────────────────────────────────
@@ -524,16 +3939,21 @@ def google_verification():
 #  APP START
 # ────────────────────────────────────────────────
 
+# 🟢 FIX: Start the expiry scheduler on import so it also runs under gunicorn,
+# where the __main__ block below is never executed
+socketio.start_background_task(cleanup_expired_rooms)
+socketio.start_background_task(reclaim_orphan_files)
+if isinstance(rooms, JournaledRoomStore):
+    socketio.start_background_task(rooms.run_journal)
+    # Graceful shutdown (deploys): write what is still queued
+    atexit.register(rooms.journal.flush, blocking=True)
+
 if __name__ == "__main__":
     # Create necessary folders
     Path("static").mkdir(exist_ok=True)
     Path("templates").mkdir(exist_ok=True)
     Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
     
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_expired_rooms, daemon=True)
-    cleanup_thread.start()
-    
     port = int(os.environ.get("PORT", 5000))
     
     print("\n" + "="*60)
@@ -0,0 +1,445 @@
+"""
+Load & benchmark suite for the file transfer rooms (localhost only).
+
+Starts the app exactly as render.yaml does (gunicorn + eventlet worker) on a
+local port, drives concurrent rooms through create / upload / download /
+download_all / destroy, optionally opens Socket.IO clients per room to time
+event delivery, and writes machine-readable results.
+
+    python benchmark.py --rooms 20 --files 3 --file-size 1048576 --clients 5
+    python benchmark.py --output new.json --compare old.json
+
+The Socket.IO scenario needs the client extras:
+    pip install "python-socketio[client]"
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# ────────────────────────────────────────────────
+#  SERVER PROCESS
+# ────────────────────────────────────────────────
+
+def read_start_command():
+    """The startCommand from render.yaml, split into argv."""
+    text = (REPO_DIR / "render.yaml").read_text()
+    match = re.search(r"^\s*startCommand:\s*(.+)$", text, re.MULTILINE)
+    if not match:
+        raise SystemExit("startCommand not found in render.yaml")
+    return shlex.split(match.group(1))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port, workdir):
+    """Run the render.yaml command from the repo directory, like Render does.
+
+    Uploads, the room journal and the server log all go to `workdir`, so the
+    run neither writes into the working tree nor reclaims files from the
+    developer's own uploads/.
+    """
+    cmd = read_start_command() + ["--bind", f"127.0.0.1:{port}"]
+    env = dict(os.environ,
+               UPLOAD_FOLDER=str(Path(workdir) / "uploads"),
+               ROOM_JOURNAL_PATH=str(Path(workdir) / "rooms.journal"))
+    log = open(Path(workdir) / "server.log", "wb")
+    proc = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"Server exited early, see {workdir}/server.log")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return proc, cmd
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit("Server did not become ready within 20s")
+
+def process_tree(pid):
+    """pid plus all of its descendants (gunicorn master + workers)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+class ResourceMonitor(threading.Thread):
+    """Samples RSS and open file descriptors of the server process tree."""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.running = True
+        self.reset()
+
+    def reset(self):
+        self.peak_rss = 0
+        self.peak_fds = 0
+
+    def sample(self):
+        rss = fds = 0
+        for pid in process_tree(self.pid):
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) * 1024
+                fds += len(os.listdir(f"/proc/{pid}/fd"))
+            except OSError:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_fds = max(self.peak_fds, fds)
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+# ────────────────────────────────────────────────
+#  HTTP CLIENT & MEASUREMENT
+# ────────────────────────────────────────────────
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+class Recorder:
+    """Thread-safe latency, error and byte counters per operation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def add(self, op, seconds, nbytes=0, ok=True):
+        with self.lock:
+            if ok:
+                self.samples.setdefault(op, []).append(seconds)
+            else:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            self.bytes[op] = self.bytes.get(op, 0) + nbytes
+
+    def summary(self, wall_seconds):
+        ops = {}
+        for op in sorted(set(self.samples) | set(self.errors)):
+            values = sorted(self.samples.get(op, []))
+            ops[op] = {
+                "count": len(values),
+                "errors": self.errors.get(op, 0),
+                "throughput_per_s": round(len(values) / wall_seconds, 2) if wall_seconds else None,
+                "bytes": self.bytes.get(op, 0),
+                "p50_ms": _ms(percentile(values, 50)),
+                "p95_ms": _ms(percentile(values, 95)),
+                "p99_ms": _ms(percentile(values, 99)),
+                "max_ms": _ms(values[-1] if values else None)
+            }
+        return ops
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+class Client:
+    """One simulated user: keep-alive connection plus the user_id cookie."""
+
+    def __init__(self, port, recorder):
+        self.port = port
+        self.recorder = recorder
+        self.cookie = None
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+
+    def request(self, op, method, path, body=None, headers=None, expect=(200, 302)):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        started = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            received = 0
+            while True:
+                chunk = resp.read(256 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+        except (OSError, http.client.HTTPException):
+            self.recorder.add(op, time.perf_counter() - started, ok=False)
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+            return None
+        elapsed = time.perf_counter() - started
+
+        set_cookie = resp.getheader("Set-Cookie")
+        if set_cookie and set_cookie.startswith("user_id="):
+            self.cookie = set_cookie.split(";", 1)[0]
+        sent = len(body) if body else 0
+        self.recorder.add(op, elapsed, sent + received, ok=resp.status in expect)
+        return resp
+
+    def create_room(self):
+        resp = self.request("create", "POST", "/create")
+        if resp is None or resp.status != 302:
+            return None
+        return urlparse(resp.getheader("Location")).path.rstrip("/").rsplit("/", 1)[-1]
+
+    def upload(self, code, filename, payload):
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            f"--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'.encode(),
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            payload,
+            f"\r\n--{boundary}--\r\n".encode()
+        ])
+        return self.request("upload", "POST", f"/upload/{code}", body,
+                            {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+# ────────────────────────────────────────────────
+#  SCENARIOS
+# ────────────────────────────────────────────────
+
+def make_payloads(count, size):
+    """Half random (incompressible) and half text-like payloads."""
+    payloads = []
+    for i in range(count):
+        if i % 2:
+            payloads.append((f"bench_{i}.txt", (b"fileportal benchmark line\n" * (size // 26 + 1))[:size]))
+        else:
+            payloads.append((f"bench_{i}.bin", os.urandom(size)))
+    return payloads
+
+def room_lifecycle(port, recorder, payloads):
+    client = Client(port, recorder)
+    code = client.create_room()
+    if not code:
+        return
+    for filename, payload in payloads:
+        client.upload(code, filename, payload)
+    for index in range(len(payloads)):
+        client.request("download", "GET", f"/download/{code}/{index}")
+    client.request("download_all", "GET", f"/download_all/{code}")
+    client.request("destroy", "POST", f"/destroy/{code}")
+
+def scenario_lifecycle(port, args, recorder):
+    payloads = make_payloads(args.files, args.file_size)
+    with ThreadPoolExecutor(max_workers=args.rooms) as pool:
+        for future in [pool.submit(room_lifecycle, port, recorder, payloads) for _ in range(args.rooms)]:
+            future.result()
+
+def room_fanout(port, recorder, payloads, listeners):
+    import socketio
+
+    client = Client(port, recorder)
+    code = client.create_room()
+    if not code:
+        return
+
+    sent_at = {}
+    pending = threading.Semaphore(0)
+
+    def on_files(files):
+        now = time.perf_counter()
+        for f in files:
+            started = sent_at.get(f["original_name"])
+            if started is not None:
+                recorder.add("socketio_event", now - started)
+                pending.release()
+
+    sockets = []
+    for _ in range(listeners):
+        sio = socketio.Client(reconnection=False)
+        sio.on("new_files", lambda data: on_files(data["files"]))
+        sio.on("room_events", lambda batch: on_files([f for u in batch["new_files"] for f in u["files"]]))
+        started = time.perf_counter()
+        try:
+            sio.connect(f"http://127.0.0.1:{port}", transports=["websocket"])
+            # call() waits for the server's join handler, so the client is in the room afterwards
+            sio.call("join", {"code": code, "batch": True}, timeout=10)
+            recorder.add("socketio_connect", time.perf_counter() - started)
+            sockets.append(sio)
+        except Exception:
+            recorder.add("socketio_connect", time.perf_counter() - started, ok=False)
+
+    for filename, payload in payloads:
+        unique_name = f"{uuid.uuid4().hex[:8]}_{filename}"
+        sent_at[unique_name] = time.perf_counter()
+        client.upload(code, unique_name, payload)
+
+    expected = len(payloads) * len(sockets)
+    deadline = time.time() + 15
+    for _ in range(expected):
+        if not pending.acquire(timeout=max(0, deadline - time.time())):
+            recorder.add("socketio_event", 0, ok=False)
+
+    for sio in sockets:
+        sio.disconnect()
+    client.request("destroy", "POST", f"/destroy/{code}")
+
+def scenario_fanout(port, args, recorder):
+    payloads = make_payloads(args.files, min(args.file_size, 64 * 1024))
+    with ThreadPoolExecutor(max_workers=args.rooms) as pool:
+        for future in [pool.submit(room_fanout, port, recorder, payloads, args.clients)
+                       for _ in range(args.rooms)]:
+            future.result()
+
+SCENARIOS = {
+    "lifecycle": scenario_lifecycle,
+    "fanout": scenario_fanout,
+}
+
+# ────────────────────────────────────────────────
+#  REPORTING
+# ────────────────────────────────────────────────
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(results):
+    print("\n" + "=" * 78)
+    print(f"📊 BENCHMARK RESULTS  (commit {results['meta']['commit']})")
+    print("=" * 78)
+    for name, scenario in results["scenarios"].items():
+        print(f"\n▶ {name}: {scenario['wall_seconds']}s wall, peak RSS "
+              f"{scenario['peak_rss_bytes'] / 1024 / 1024:.1f} MB, peak fds {scenario['peak_fds']}")
+        print(f"   {'operation':<18}{'count':>7}{'err':>5}{'ops/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for op, s in scenario["operations"].items():
+            print(f"   {op:<18}{s['count']:>7}{s['errors']:>5}{s['throughput_per_s'] or 0:>9}"
+                  f"{s['p50_ms'] or 0:>10}{s['p95_ms'] or 0:>10}{s['p99_ms'] or 0:>10}")
+
+def print_comparison(old, new):
+    """p95 and throughput deltas for every operation present in both result files."""
+    print("\n" + "=" * 78)
+    print(f"🔍 COMPARISON  {old['meta']['commit']} → {new['meta']['commit']}")
+    print("=" * 78)
+    for name, scenario in new["scenarios"].items():
+        previous = old["scenarios"].get(name)
+        if not previous:
+            continue
+        print(f"\n▶ {name}")
+        for op, s in scenario["operations"].items():
+            before = previous["operations"].get(op)
+            if not before or not before["p95_ms"] or not s["p95_ms"]:
+                continue
+            change = (s["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+            flag = "⚠️" if change > 10 else "  "
+            print(f"   {flag} {op:<18} p95 {before['p95_ms']:>9} → {s['p95_ms']:>9} ms ({change:+.1f}%)"
+                  f"   ops/s {before['throughput_per_s']} → {s['throughput_per_s']}")
+
+# ────────────────────────────────────────────────
+#  MAIN
+# ────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description="Localhost load test for the file transfer rooms")
+    parser.add_argument("--rooms", type=int, default=10, help="concurrent rooms (N)")
+    parser.add_argument("--clients", type=int, default=5, help="Socket.IO clients per room (M)")
+    parser.add_argument("--files", type=int, default=3, help="files uploaded per room")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="bytes per uploaded file")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated scenario names")
+    parser.add_argument("--output", default="bench_results.json", help="where to write JSON results")
+    parser.add_argument("--compare", help="earlier results file to diff against")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+    if "fanout" in names:
+        try:
+            import socketio  # noqa: F401
+            import websocket  # noqa: F401
+        except ImportError:
+            print('⚠️  Skipping fanout: pip install "python-socketio[client]" to enable it')
+            names.remove("fanout")
+
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="fileportal-bench-") as workdir:
+        proc, cmd = start_server(port, workdir)
+        monitor = ResourceMonitor(proc.pid)
+        monitor.start()
+        results = {
+            "meta": {
+                "commit": git_commit(),
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "command": cmd,
+                "python": sys.version.split()[0],
+                "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+            },
+            "scenarios": {}
+        }
+        try:
+            for name in names:
+                print(f"🚀 Running {name} ({args.rooms} rooms)...")
+                recorder = Recorder()
+                monitor.reset()
+                started = time.perf_counter()
+                SCENARIOS[name](port, args, recorder)
+                wall = time.perf_counter() - started
+                monitor.sample()
+                results["scenarios"][name] = {
+                    "wall_seconds": round(wall, 3),
+                    "peak_rss_bytes": monitor.peak_rss,
+                    "peak_fds": monitor.peak_fds,
+                    "operations": recorder.summary(wall)
+                }
+        finally:
+            monitor.running = False
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print_report(results)
+    print(f"\n💾 Results written to {args.output}")
+
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), results)
+
+if __name__ == "__main__":
+    main()